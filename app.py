@@ -1,29 +1,508 @@
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+import time
+
+STARTUP_BEGAN = time.perf_counter()  # taken before the imports below so cold start is measured in full
+
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaDocument, Message
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
 from telegram.request import HTTPXRequest
-import yt_dlp
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+from aiohttp import web
+import httpx
 import os
 import asyncio
 import logging
-import time
 import subprocess
-import requests
 import random
 import shutil
 import socket
+import threading
+import copy
+import urllib.parse
+import json
+import sqlite3
+import functools
+import hmac
+import hashlib
+import tempfile
+import contextlib
+import mimetypes
+import pathlib
+import secrets
+import signal
+import contextvars
+import io
+import re
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-job trace IDs in log lines ("-" outside a job)
+LOG_TRACE_IDS = os.getenv("LOG_TRACE_IDS", "false").lower() in ('1', 'true', 'yes')
+trace_id_var = contextvars.ContextVar('trace_id', default='-')
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id_var.get()
+        return True
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+if LOG_TRACE_IDS:
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:[%(trace_id)s] %(message)s")
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
+else:
+    logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+IMPORTS_DONE = time.perf_counter()
+
+# Metrics, served in Prometheus text format on /metrics
+METRICS_PREFIX = "ytbot_"
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """Monotonic counter; safe to increment from worker threads"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = METRICS_PREFIX + name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, format_labels(self.labels, key), value) for key, value in self.values.items()]
+
+class Gauge:
+    """Point-in-time value, either set directly or read from a callback at scrape time"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        self.name = METRICS_PREFIX + name
+        self.help = help_text
+        self.labels = labels
+        self.callback = callback  # returns a value, or a dict of label tuple -> value
+        self.values = {}
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def samples(self):
+        values = dict(self.values)
+        if self.callback:
+            current = self.callback()
+            values.update(current if isinstance(current, dict) else {(): current})
+        return [(self.name, format_labels(self.labels, key), value) for key, value in values.items()]
+
+class Histogram:
+    """Cumulative-bucket histogram; safe to observe from worker threads"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        self.name = METRICS_PREFIX + name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts..., count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, series in self.series.items():
+                for bound, count in zip(self.buckets, series):
+                    samples.append((f"{self.name}_bucket", format_labels(self.labels, key, [('le', bound)]), count))
+                samples.append((f"{self.name}_bucket", format_labels(self.labels, key, [('le', '+Inf')]), series[-2]))
+                samples.append((f"{self.name}_count", format_labels(self.labels, key), series[-2]))
+                samples.append((f"{self.name}_sum", format_labels(self.labels, key), series[-1]))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+stage_seconds = metrics.register(Histogram("stage_seconds", "Time spent in each download pipeline stage", ('stage',)))
+pool_wait_seconds = metrics.register(Histogram("pool_wait_seconds", "Time jobs waited for a worker thread", ('pool',)))
+probes_total = metrics.register(Counter("probes_total", "Metadata probe attempts by strategy", ('strategy', 'outcome')))
+jobs_total = metrics.register(Counter("jobs_total", "Finished download jobs by outcome", ('outcome',)))
+retry_after_total = metrics.register(Counter("telegram_retry_after_total", "Telegram 429 responses"))
+retry_after_seconds_total = metrics.register(Counter("telegram_retry_after_seconds_total", "Total retry_after seconds Telegram asked for"))
+loop_lag_seconds = metrics.register(Histogram("event_loop_lag_seconds", "Event loop wake-up delay",
+                                              buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)))
+
+def record_retry_after(seconds):
+    retry_after_total.inc()
+    retry_after_seconds_total.inc(amount=seconds)
+
+class MeteredRequest(HTTPXRequest):
+    """Every Bot API call PTB makes goes through post(), so flood-control answers are counted here once.
+    Uploads that bypass PTB (upload_document, upload_media_group) count theirs in bot_api_result"""
+
+    async def post(self, *args, **kwargs):
+        try:
+            return await super().post(*args, **kwargs)
+        except RetryAfter as e:
+            record_retry_after(e.retry_after)
+            raise
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a short sleep"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = 0.0
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, time.perf_counter() - started - self.interval)
+            loop_lag_seconds.observe(self.last)
+
+loop_lag_monitor = LoopLagMonitor(float(os.getenv("LOOP_LAG_INTERVAL", "0.5")))
+metrics.register(Gauge("event_loop_lag_last_seconds", "Most recent event loop wake-up delay",
+                       callback=lambda: loop_lag_monitor.last))
+
+# Shared state backend: "memory" (default), a SQLite file path, or a redis:// URL
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+
+class StateBackend:
+    """Key/value store for sessions, caches and scheduler counters, grouped by namespace"""
+
+    # Whether other processes can see the state (values are then JSON-encoded)
+    shared = False
+    # Whether calls wait on disk or network; the async variants then run them on a thread
+    blocking = False
+
+    def get(self, namespace, key):
+        """Return (value, expires) or None if missing or expired"""
+        raise NotImplementedError
+
+    def set(self, namespace, key, value, expires, max_entries=None):
+        """Store value until the expires timestamp, evicting least recently used entries over max_entries"""
+        raise NotImplementedError
+
+    def delete(self, namespace, key):
+        raise NotImplementedError
+
+    def incr(self, namespace, key, delta, expires):
+        """Atomically add delta to an integer counter and return the new value"""
+        raise NotImplementedError
+
+    async def _call(self, func, *args, **kwargs):
+        if self.blocking:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        return func(*args, **kwargs)
+
+    # Event-loop code uses these, so a slow disk or a locked database never stalls the bot
+    async def aget(self, namespace, key):
+        return await self._call(self.get, namespace, key)
+
+    async def aset(self, namespace, key, value, expires, max_entries=None):
+        await self._call(self.set, namespace, key, value, expires, max_entries)
+
+    async def adelete(self, namespace, key):
+        await self._call(self.delete, namespace, key)
+
+    async def aincr(self, namespace, key, delta, expires):
+        return await self._call(self.incr, namespace, key, delta, expires)
+
+_background_writes = set()
+
+def write_behind(coro, what):
+    """Run a state write without waiting for it; failures are logged, not raised"""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_writes.add(task)
+
+    def done(task):
+        _background_writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Background write failed ({what}): {task.exception()!r}")
+
+    task.add_done_callback(done)
+    return task
+
+class MemoryBackend(StateBackend):
+    """Process-local backend; values are stored as-is without serialization"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.namespaces = {}  # namespace -> OrderedDict(key -> (value, expires)), least recently used first
+
+    def _entries(self, namespace):
+        return self.namespaces.setdefault(namespace, OrderedDict())
+
+    def get(self, namespace, key):
+        with self.lock:
+            entries = self._entries(namespace)
+            entry = entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del entries[key]
+                return None
+            entries.move_to_end(key)
+            return entry
+
+    def set(self, namespace, key, value, expires, max_entries=None):
+        with self.lock:
+            entries = self._entries(namespace)
+            entries[key] = (value, expires)
+            entries.move_to_end(key)
+            now = time.time()
+            while entries:
+                oldest_value, oldest_expires = next(iter(entries.values()))
+                if oldest_expires > now and (not max_entries or len(entries) <= max_entries):
+                    break
+                entries.popitem(last=False)
+
+    def delete(self, namespace, key):
+        with self.lock:
+            self._entries(namespace).pop(key, None)
+
+    def incr(self, namespace, key, delta, expires):
+        with self.lock:
+            entries = self._entries(namespace)
+            entry = entries.get(key)
+            value = (entry[0] if entry and entry[1] > time.time() else 0) + delta
+            entries[key] = (value, expires)
+            return value
+
+class SQLiteBackend(StateBackend):
+    """SQLite backend in WAL mode; several processes can share the file on a common volume"""
+
+    shared = True
+    blocking = True
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.tables = set()
+        self.touched = {}  # table -> {key: last read time}, written back with the next set()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def _table(self, namespace):
+        if not namespace.isidentifier():
+            raise ValueError(f"Invalid namespace: {namespace}")
+        if namespace not in self.tables:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {namespace} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)"
+            )
+            self.conn.commit()
+            self.tables.add(namespace)
+        return namespace
 
-# Store user choices
-user_links = {}
-user_formats = {}  # Store chosen format (mp3/mp4)
-user_messages = {}  # Store message IDs for editing
+    def get(self, namespace, key):
+        # Reads never write: expired rows are swept by set(), and LRU order is updated there too
+        now = time.time()
+        with self.lock:
+            table = self._table(namespace)
+            row = self.conn.execute(f"SELECT value, expires FROM {table} WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                return None
+            self.touched.setdefault(table, {})[key] = now
+        return json.loads(row[0]), row[1]
 
-# Store last progress update time to avoid too frequent updates
-last_update_time = {}
-last_percent = {}
+    def set(self, namespace, key, value, expires, max_entries=None):
+        with self.lock:
+            table = self._table(namespace)
+            touched = self.touched.pop(table, None)
+            if touched:
+                self.conn.executemany(
+                    f"UPDATE {table} SET used = ? WHERE key = ? AND used < ?",
+                    ((used, touched_key, used) for touched_key, used in touched.items())
+                )
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {table} (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires, time.time())
+            )
+            if max_entries:
+                # Drop expired rows, then the least recently used ones over the limit
+                self.conn.execute(f"DELETE FROM {table} WHERE expires <= ?", (time.time(),))
+                self.conn.execute(
+                    f"DELETE FROM {table} WHERE key IN "
+                    f"(SELECT key FROM {table} ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (max_entries,)
+                )
+            self.conn.commit()
+
+    def delete(self, namespace, key):
+        with self.lock:
+            table = self._table(namespace)
+            self.conn.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def incr(self, namespace, key, delta, expires):
+        now = time.time()
+        with self.lock:
+            table = self._table(namespace)
+            with self.conn:
+                self.conn.execute(
+                    f"INSERT INTO {table} (key, value, expires, used) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET "
+                    "value = CASE WHEN expires <= excluded.used THEN excluded.value "
+                    "ELSE CAST(CAST(value AS INTEGER) + ? AS TEXT) END, "
+                    "expires = excluded.expires, used = excluded.used",
+                    (key, str(delta), expires, now, delta)
+                )
+                row = self.conn.execute(f"SELECT value FROM {table} WHERE key = ?", (key,)).fetchone()
+        return int(row[0])
+
+class RedisBackend(StateBackend):
+    """Redis (or any Redis-protocol server) backend; eviction is left to the server's maxmemory policy"""
+
+    shared = True
+    blocking = True
+
+    def __init__(self, url, prefix="ytbot:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND is a redis:// URL but the 'redis' package is not installed")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, namespace, key):
+        return f"{self.prefix}{namespace}:{key}"
+
+    def get(self, namespace, key):
+        pipe = self.client.pipeline()
+        pipe.get(self._key(namespace, key))
+        pipe.pttl(self._key(namespace, key))
+        value, ttl_ms = pipe.execute()
+        if value is None:
+            return None
+        expires = time.time() + ttl_ms / 1000 if ttl_ms and ttl_ms > 0 else float('inf')
+        return json.loads(value), expires
+
+    def set(self, namespace, key, value, expires, max_entries=None):
+        ttl_ms = max(int((expires - time.time()) * 1000), 1)
+        self.client.set(self._key(namespace, key), json.dumps(value), px=ttl_ms)
+
+    def delete(self, namespace, key):
+        self.client.delete(self._key(namespace, key))
+
+    def incr(self, namespace, key, delta, expires):
+        name = self._key(namespace, key)
+        pipe = self.client.pipeline()
+        pipe.incrby(name, delta)
+        pipe.pexpire(name, max(int((expires - time.time()) * 1000), 1))
+        value, _ = pipe.execute()
+        return int(value)
+
+@functools.lru_cache(maxsize=None)
+def create_backend(spec):
+    """Build (once per spec) a backend from "memory", "redis://...", or a SQLite file path"""
+    if not spec or spec == "memory":
+        return MemoryBackend()
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(spec)
+    if spec.startswith("sqlite:///"):
+        spec = spec[len("sqlite:///"):]
+    return SQLiteBackend(spec)
+
+state_backend = create_backend(STATE_BACKEND)
+
+# Pending link sessions
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+
+class Session:
+    """One link a user sent, waiting for (or running) a download"""
+
+    __slots__ = ('token', 'chat_id', 'user_id', 'url', 'format_type', 'expires', 'urls')
+
+    def __init__(self, token, chat_id, user_id, url, expires, format_type=None, urls=None):
+        self.token = token
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.url = url
+        self.format_type = format_type
+        self.expires = expires
+        self.urls = urls  # every link of a batch request; None for a single link
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+class SessionStore:
+    """Expiring sessions keyed by the short token carried in callback_data"""
+
+    def __init__(self, backend, ttl, max_size):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_size = max_size
+
+    async def create(self, chat_id, user_id, url, urls=None):
+        session = Session(secrets.token_urlsafe(6), chat_id, user_id, url, time.time() + self.ttl, urls=urls)
+        await self.save(session)
+        return session
+
+    async def save(self, session):
+        """Store the session; needed after changing it when the backend is shared"""
+        value = session.to_dict() if self.backend.shared else session
+        await self.backend.aset("sessions", session.token, value, session.expires, max_entries=self.max_size)
+
+    async def get(self, token):
+        stored = await self.backend.aget("sessions", token)
+        if stored is None:
+            return None
+        value = stored[0]
+        return value if isinstance(value, Session) else Session(**value)
+
+    async def pop(self, token):
+        await self.backend.adelete("sessions", token)
+
+sessions = SessionStore(state_backend, SESSION_TTL, SESSION_MAX)
+
+def parse_callback(data):
+    """Split 'choice:token' callback data into (choice, token)"""
+    choice, _, token = data.partition(':')
+    return choice, token
 
 # User agents to rotate
 USER_AGENTS = [
@@ -34,115 +513,523 @@ USER_AGENTS = [
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:121.0) Gecko/20100101 Firefox/121.0'
 ]
 
+# Extraction worker pool settings
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+EXTRACT_QUEUE_SIZE = int(os.getenv("EXTRACT_QUEUE_SIZE", "32"))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "120"))
+
+# How long probed stream URLs are trusted when the URLs carry no expiry of their own
+INFO_MAX_AGE = int(os.getenv("INFO_MAX_AGE", "3600"))
+# Minimum remaining URL lifetime needed to reuse a probed info dict for downloading
+INFO_EXPIRY_MARGIN = int(os.getenv("INFO_EXPIRY_MARGIN", "300"))
+
+class WorkerPool:
+    """Bounded thread pool for blocking work, with a queue limit, timeouts and timing stats"""
+
+    def __init__(self, name, workers, max_queue, timeout):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.stats = {
+            'completed': 0,
+            'failed': 0,
+            'timeouts': 0,
+            'cancelled': 0,
+            'rejected': 0,
+            'queue_wait_total': 0.0,
+            'run_total': 0.0,
+        }
+
+    def _finished(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def _record(self, label, timings, ok):
+        wait = timings.get('wait')
+        run = timings.get('run')
+        with self.lock:
+            self.stats['completed' if ok else 'failed'] += 1
+            if wait is not None:
+                self.stats['queue_wait_total'] += wait
+            if run is not None:
+                self.stats['run_total'] += run
+        if wait is not None and run is not None:
+            logger.info(f"⏱️ {label}: waited {wait:.2f}s in queue, ran {run:.2f}s")
+
+    async def run(self, func, *args, timeout=None, label=None):
+        """Run func(*args) on a worker thread, with a queue limit and timeout"""
+        timeout = timeout or self.timeout
+        label = label or self.name
+        with self.lock:
+            if self.pending >= self.max_queue:
+                self.stats['rejected'] += 1
+                raise Exception(f"{self.name.capitalize()} queue is full - server busy, please try again shortly")
+            self.pending += 1
+
+        submitted = time.monotonic()
+        timings = {}
+
+        def job():
+            started = time.monotonic()
+            timings['wait'] = started - submitted
+            pool_wait_seconds.observe(timings['wait'], self.name)
+            try:
+                return func(*args)
+            finally:
+                timings['run'] = time.monotonic() - started
+
+        # Carry the caller's context (trace ID) onto the worker thread
+        future = self.executor.submit(contextvars.copy_context().run, job)
+        future.add_done_callback(self._finished)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            # A running extraction can't be interrupted; its result is simply discarded
+            future.cancel()
+            with self.lock:
+                self.stats['timeouts'] += 1
+            logger.warning(f"⏱️ {label} timed out after {timeout:.0f}s")
+            raise Exception(f"{self.name.capitalize()} timed out after {timeout:.0f}s")
+        except asyncio.CancelledError:
+            future.cancel()
+            with self.lock:
+                self.stats['cancelled'] += 1
+            raise
+        except Exception:
+            self._record(label, timings, ok=False)
+            raise
+        self._record(label, timings, ok=True)
+        return result
+
+    def queue_depth(self):
+        """Number of jobs submitted but not yet finished"""
+        with self.lock:
+            return self.pending
+
+extraction_pool = WorkerPool("extraction", EXTRACT_WORKERS, EXTRACT_QUEUE_SIZE, EXTRACT_TIMEOUT)
+
 def check_network():
     """Check basic network connectivity"""
     try:
-        socket.create_connection(("8.8.8.8", 53), timeout=5)
-        logger.info("✅ Network connectivity OK")
+        socket.create_connection(("8.8.8.8", 53), timeout=5).close()
+        return True
+    except OSError:
+        return False
+
+def check_dns():
+    """Check that DNS resolution works"""
+    try:
+        socket.getaddrinfo(HEALTH_DNS_HOST, 443)
         return True
     except OSError:
-        logger.warning("⚠️ Network connectivity issues detected")
         return False
 
 def check_ffmpeg():
     """Check if FFmpeg is available"""
     try:
         subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-        logger.info("✅ FFmpeg is available")
         return True
     except (subprocess.CalledProcessError, FileNotFoundError):
-        logger.warning("⚠️ FFmpeg not found")
         return False
 
 def check_ffprobe():
     """Check if FFprobe is available"""
     try:
         subprocess.run(['ffprobe', '-version'], capture_output=True, check=True)
-        logger.info("✅ FFprobe is available")
         return True
     except (subprocess.CalledProcessError, FileNotFoundError):
-        logger.warning("⚠️ FFprobe not found")
         return False
 
-# Check FFmpeg availability at startup
-FFMPEG_AVAILABLE = check_ffmpeg()
-FFPROBE_AVAILABLE = check_ffprobe()
+# Cheap PATH lookups for startup; the health monitor confirms them by running the binaries
+FFMPEG_AVAILABLE = shutil.which('ffmpeg') is not None
+FFPROBE_AVAILABLE = shutil.which('ffprobe') is not None
+
+# Health monitor settings
+HEALTH_CHECK_INTERVAL = int(os.getenv("HEALTH_CHECK_INTERVAL", "30"))
+HEALTH_OFFLINE_INTERVAL = int(os.getenv("HEALTH_OFFLINE_INTERVAL", "5"))  # recheck faster while offline
+HEALTH_OFFLINE_WAIT = int(os.getenv("HEALTH_OFFLINE_WAIT", "300"))  # how long jobs wait for the network to return
+HEALTH_DNS_HOST = os.getenv("HEALTH_DNS_HOST", "www.youtube.com")
+
+class HealthMonitor:
+    """Periodically checks connectivity, DNS and FFmpeg in the background;
+    handlers read the cached status instead of probing per request"""
+
+    def __init__(self):
+        self.status = {'network': None, 'dns': None, 'ffmpeg': FFMPEG_AVAILABLE,
+                       'ffprobe': FFPROBE_AVAILABLE, 'checked_at': None}
+        self.online_event = asyncio.Event()
+        self.online_event.set()  # assume online until a check says otherwise
+
+    @property
+    def online(self):
+        return self.online_event.is_set()
+
+    async def _probe(self, func):
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(func), 10)
+        except asyncio.TimeoutError:
+            return False
+
+    async def check(self):
+        global FFMPEG_AVAILABLE, FFPROBE_AVAILABLE
+        network, dns, ffmpeg, ffprobe = await asyncio.gather(
+            self._probe(check_network), self._probe(check_dns),
+            self._probe(check_ffmpeg), self._probe(check_ffprobe))
+
+        previous = dict(self.status)
+        self.status.update(network=network, dns=dns, ffmpeg=ffmpeg, ffprobe=ffprobe, checked_at=time.time())
+        for name in ('network', 'dns', 'ffmpeg', 'ffprobe'):
+            if previous[name] != self.status[name]:
+                if self.status[name]:
+                    logger.info(f"✅ Health: {name} OK")
+                else:
+                    logger.warning(f"⚠️ Health: {name} unavailable")
+        FFMPEG_AVAILABLE = ffmpeg
+        FFPROBE_AVAILABLE = ffprobe
+
+        if network and dns:
+            self.online_event.set()
+        else:
+            self.online_event.clear()
+
+    async def wait_online(self, timeout):
+        """Wait for connectivity to return; False if it is still down after timeout seconds"""
+        try:
+            await asyncio.wait_for(self.online_event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def snapshot(self):
+        healthy = self.status['network'] is not False and self.status['dns'] is not False
+        checked_at = self.status['checked_at']
+        return {
+            'status': 'ok' if healthy else 'degraded',
+            'network': self.status['network'],
+            'dns': self.status['dns'],
+            'ffmpeg': self.status['ffmpeg'],
+            'ffprobe': self.status['ffprobe'],
+            'checked_ago': round(time.time() - checked_at) if checked_at else None,
+        }
+
+    async def run(self):
+        """Background loop; checks more often while the network is down"""
+        while True:
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Health check error: {e}")
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL if self.online else HEALTH_OFFLINE_INTERVAL)
+
+health = HealthMonitor()
+
+# Membership gate settings
+MEMBERSHIP_CHAT = os.getenv("MEMBERSHIP_CHAT", "@LotusDevCommunity")
+MEMBER_CACHE_TTL = int(os.getenv("MEMBER_CACHE_TTL", "21600"))
+NON_MEMBER_CACHE_TTL = int(os.getenv("NON_MEMBER_CACHE_TTL", "60"))
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "50000"))
+# Longest flood-control wait honoured inside one check before letting the user through
+MEMBER_CHECK_MAX_WAIT = float(os.getenv("MEMBER_CHECK_MAX_WAIT", "5"))
+
+class MembershipService:
+    """Cached group-membership checks with separate TTLs for members and non-members"""
+
+    def __init__(self, chat, member_ttl, non_member_ttl, max_size):
+        self.chat = chat
+        self.member_ttl = member_ttl
+        self.non_member_ttl = non_member_ttl
+        self.max_size = max_size
+        self.cache = OrderedDict()  # user_id -> (is_member, expires)
+        self.inflight = {}  # user_id -> asyncio.Task of the lookup in progress
+        self.stats = {'hits': 0, 'lookups': 0, 'coalesced': 0}
+
+    def cached(self, user_id):
+        """Cached membership (True/False), or None if unknown or expired"""
+        entry = self.cache.get(user_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self.cache[user_id]
+            return None
+        return entry[0]
+
+    def remember(self, user_id, is_member):
+        ttl = self.member_ttl if is_member else self.non_member_ttl
+        self.cache[user_id] = (is_member, time.time() + ttl)
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    async def is_member(self, bot, user_id):
+        cached = self.cached(user_id)
+        if cached is not None:
+            self.stats['hits'] += 1
+            return cached
+        task = self.inflight.get(user_id)
+        if task is not None:
+            self.stats['coalesced'] += 1
+        else:
+            task = asyncio.create_task(self._lookup(bot, user_id))
+            self.inflight[user_id] = task
+            task.add_done_callback(lambda t: self.inflight.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _lookup(self, bot, user_id):
+        """Only a real getChatMember status is cached; when Telegram can't answer, the user is let
+        through uncached rather than locked out for the non-member TTL"""
+        self.stats['lookups'] += 1
+        for attempt in range(2):
+            try:
+                member = await bot.get_chat_member(self.chat, user_id)
+            except BadRequest as e:
+                if "user not found" in str(e).lower():
+                    return False  # never seen by Telegram in this chat; not a status, so not cached
+                logger.error(f"🚨 Membership check misconfigured for {self.chat} (is MEMBERSHIP_CHAT right?): {e}")
+                return True
+            except Forbidden as e:
+                logger.error(f"🚨 Bot cannot see members of {self.chat} (is it an admin there?): {e}")
+                return True
+            except RetryAfter as e:
+                if attempt or e.retry_after > MEMBER_CHECK_MAX_WAIT:
+                    logger.warning(f"Membership check for {user_id} rate limited, letting through: {e}")
+                    return True
+                await asyncio.sleep(e.retry_after)
+            except TelegramError as e:
+                if attempt:
+                    logger.warning(f"Membership check for {user_id} failed, letting through: {e}")
+                    return True
+            else:
+                is_member = member.status in ["member", "administrator", "creator"]
+                self.remember(user_id, is_member)
+                return is_member
+
+membership = MembershipService(MEMBERSHIP_CHAT, MEMBER_CACHE_TTL, NON_MEMBER_CACHE_TTL, MEMBER_CACHE_SIZE)
+
+async def send_join_prompt(context: CallbackContext, chat_id):
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Join Group", url=f"https://t.me/{MEMBERSHIP_CHAT.strip('@')}")]])
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="🚫 You must join our group to use this bot. Click below to join and then send /start again.",
+        reply_markup=keyboard
+    )
 
 async def start(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    group_username = "@LotusDevCommunity"
 
-    try:
-        member = await context.bot.get_chat_member(group_username, user_id)
-        if member.status in ["member", "administrator", "creator"]:
-            welcome_text = (
-                "👋 Welcome!\n"
-                "Send me any video URL (YouTube, etc.) and I will help you download it.\n"
-                "You can choose to download it as MP3 (audio) or MP4 (video).\n"
-                "Just send me the link to get started!"
-            )
-            await context.bot.send_message(chat_id=chat_id, text=welcome_text)
-        else:
-            raise Exception("Not a member")
-    except:
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Join Group", url=f"https://t.me/{group_username.strip('@')}")]])
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="🚫 You must join our group to use this bot. Click below to join and then send /start again.",
-            reply_markup=keyboard
+    if await membership.is_member(context.bot, user_id):
+        welcome_text = (
+            "👋 Welcome!\n"
+            "Send me any video URL (YouTube, etc.) and I will help you download it.\n"
+            "You can choose to download it as MP3 (audio) or MP4 (video).\n"
+            "Just send me the link to get started!"
         )
+        await context.bot.send_message(chat_id=chat_id, text=welcome_text)
+    else:
+        await send_join_prompt(context, chat_id)
 
 async def handle_message(update: Update, context: CallbackContext):
-    url = update.message.text
+    urls = extract_urls(update.message.text)
     user_id = update.message.chat_id
 
-    user_links[user_id] = url
+    if not urls:
+        await update.message.reply_text("❌ Please send a valid video link.")
+        return
 
-    keyboard = [
-        [InlineKeyboardButton("🎵 MP3", callback_data='mp3')],
-        [InlineKeyboardButton("🎥 MP4", callback_data='mp4')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Cached for hours after the first check, so this is normally free
+    if not await membership.is_member(context.bot, update.effective_user.id):
+        await send_join_prompt(context, user_id)
+        return
     
     # Add warning if FFmpeg is not available
     warning_text = ""
     if not FFMPEG_AVAILABLE:
         warning_text = "\n⚠️ Note: MP3 conversion may not be available without FFmpeg"
     
+    # Several links or a playlist: one format choice for the whole batch
+    if len(urls) > 1 or is_playlist_url(urls[0]):
+        urls = urls[:BATCH_MAX_ITEMS]
+        session = await sessions.create(user_id, update.effective_user.id, urls[0], urls=urls)
+        token = session.token
+        keyboard = [
+            [InlineKeyboardButton("🎵 MP3", callback_data=f'batch_mp3:{token}'), InlineKeyboardButton("🎧 M4A", callback_data=f'batch_m4a:{token}')],
+            [InlineKeyboardButton("🎥 MP4 720p", callback_data=f'batch_720:{token}'), InlineKeyboardButton("🎥 MP4 Best", callback_data=f'batch_best:{token}')],
+            [InlineKeyboardButton("❌ Cancel", callback_data=f'cancel:{token}')],
+        ]
+        what = f"{len(urls)} links" if len(urls) > 1 else "This playlist"
+        await update.message.reply_text(
+            f"📦 {what} will be downloaded as one batch (up to {BATCH_MAX_ITEMS} videos).\n"
+            f"Choose the format for all of them:{warning_text}",
+            reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    session = await sessions.create(user_id, update.effective_user.id, urls[0])
+    token = session.token
+    if PREFETCH_ENABLED:
+        prefetcher.start(session)
+
+    keyboard = [
+        [InlineKeyboardButton("🎵 MP3", callback_data=f'mp3:{token}'), InlineKeyboardButton("🎧 M4A", callback_data=f'm4a:{token}')],
+        [InlineKeyboardButton("🎥 MP4", callback_data=f'mp4:{token}')],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
     await update.message.reply_text(f"Choose the format:{warning_text}", reply_markup=reply_markup)
 
-def download_cookies():
+# Cookie settings
+COOKIES_SOURCE = os.getenv("COOKIES_SOURCE")  # local path or http(s) URL of a cookies.txt
+COOKIES_REFRESH_INTERVAL = int(os.getenv("COOKIES_REFRESH_INTERVAL", "1800"))
+COOKIES_DIR = os.getenv("COOKIES_DIR", "cookies")
+
+def get_cookies_source():
+    """Resolve where cookies come from: COOKIES_SOURCE, the GitLab repo file, or a local cookies.txt"""
+    if COOKIES_SOURCE:
+        return COOKIES_SOURCE, {}
     token = os.getenv("GITLAB_TOKEN")
-    if not token:
-        logger.warning("GITLAB_TOKEN not found, skipping cookie download")
-        return False
-        
-    headers = {"PRIVATE-TOKEN": token}
-    project_path = "Lotus-Kattini/telegram"
-    file_path = "cookies.txt"
-    branch = "main"
-    import urllib.parse
-    project_path_enc = urllib.parse.quote_plus(project_path)
-    file_path_enc = urllib.parse.quote_plus(file_path)
+    if token:
+        project_path_enc = urllib.parse.quote_plus("Lotus-Kattini/telegram")
+        file_path_enc = urllib.parse.quote_plus("cookies.txt")
+        url = f"https://gitlab.com/api/v4/projects/{project_path_enc}/repository/files/{file_path_enc}/raw?ref=main"
+        return url, {"PRIVATE-TOKEN": token}
+    if os.path.exists("cookies.txt"):
+        return "cookies.txt", {}
+    logger.warning("No cookie source configured (GITLAB_TOKEN / COOKIES_SOURCE), running without cookies")
+    return None, {}
 
-    url = f"https://gitlab.com/api/v4/projects/{project_path_enc}/repository/files/{file_path_enc}/raw?ref={branch}"
+class CookieManager:
+    """Keeps a content-addressed cookies snapshot fresh in the background and hands out per-job copies"""
 
-    try:
-        r = requests.get(url, headers=headers, timeout=10)
-        if r.status_code == 200:
-            with open("cookies.txt", "wb") as f:
-                f.write(r.content)
-            logger.info("✅ cookies.txt downloaded successfully.")
-            return True
+    def __init__(self, source, headers, directory, interval):
+        self.source = source
+        self.headers = headers
+        self.directory = directory
+        self.interval = interval
+        self.etag = None
+        os.makedirs(directory, exist_ok=True)
+        # Start from the newest snapshot left by a previous run, if any
+        snapshots = self._snapshots()
+        self.current = snapshots[-1] if snapshots else None
+
+    def _snapshots(self):
+        paths = [os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                 if f.startswith("cookies-") and f.endswith(".txt")]
+        return sorted(paths, key=os.path.getmtime)
+
+    def _write_snapshot(self, content, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        # Keep the current snapshot and one spare
+        for old in self._snapshots()[:-2]:
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    async def refresh(self):
+        """Fetch the source once; returns True if a new snapshot was written"""
+        if not self.source:
+            return False
+        if self.source.startswith(("http://", "https://")):
+            headers = dict(self.headers)
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            async with httpx.AsyncClient(timeout=10) as client:
+                r = await client.get(self.source, headers=headers)
+            if r.status_code == 304:
+                return False
+            if r.status_code != 200:
+                logger.error(f"❌ Failed to download cookies.txt: {r.status_code}")
+                return False
+            self.etag = r.headers.get("ETag")
+            content = r.content
         else:
-            logger.error(f"❌ Failed to download cookies.txt: {r.status_code}")
+            content = await asyncio.to_thread(pathlib.Path(self.source).read_bytes)
+
+        path = os.path.join(self.directory, f"cookies-{hashlib.sha1(content).hexdigest()[:16]}.txt")
+        if path == self.current and os.path.exists(path):
             return False
-    except Exception as e:
-        logger.error(f"❌ Error downloading cookies: {e}")
-        return False
+        await asyncio.to_thread(self._write_snapshot, content, path)
+        self.current = path
+        logger.info(f"✅ cookies.txt refreshed ({len(content)} bytes)")
+        return True
+
+    async def run(self):
+        """Background refresh loop"""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"❌ Error refreshing cookies: {e}")
+            await asyncio.sleep(self.interval)
+
+    @contextlib.contextmanager
+    def checkout(self):
+        """Private copy of the current snapshot for one yt-dlp run, since yt-dlp writes cookies back on exit"""
+        path = None
+        snapshot = self.current
+        if snapshot:
+            fd, path = tempfile.mkstemp(prefix="job-", suffix=".txt", dir=self.directory)
+            os.close(fd)
+            try:
+                shutil.copyfile(snapshot, path)
+            except OSError:
+                os.remove(path)
+                path = None
+        try:
+            yield path
+        finally:
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+cookie_manager = CookieManager(*get_cookies_source(), COOKIES_DIR, COOKIES_REFRESH_INTERVAL)
+
+# Progress / edit rate settings
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "2.0"))
+EDIT_RATE = float(os.getenv("EDIT_RATE", "20"))  # edits per second across all chats
+EDIT_BURST = int(os.getenv("EDIT_BURST", "20"))
+
+class TokenBucket:
+    """Async token bucket shared by all chats to stay under Telegram's per-bot limits"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        """Stop handing out tokens for a while (after a 429 from Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+edit_limiter = TokenBucket(EDIT_RATE, EDIT_BURST)
 
 async def safe_edit_message(context: CallbackContext, user_id: int, message_id: int, text: str):
+    await edit_limiter.acquire()
     try:
         await context.bot.edit_message_text(
             chat_id=user_id,
@@ -151,259 +1038,962 @@ async def safe_edit_message(context: CallbackContext, user_id: int, message_id:
             parse_mode='Markdown'
         )
         return True
+    except RetryAfter as e:
+        edit_limiter.pause(e.retry_after)
+        logger.warning(f"Edit rate limited, pausing edits for {e.retry_after}s")
+        return False
     except Exception as e:
         if "Message is not modified" not in str(e):
             logger.warning(f"Failed to edit message: {e}")
         return False
 
-async def progress_hook(d, context: CallbackContext, user_id, message_id):
-    try:
-        if d.get('status') == 'downloading':
-            downloaded_bytes = d.get('downloaded_bytes', 0)
-            total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate')
-            speed = d.get('speed', 0)
-            current_time = time.time()
-            if total_bytes and total_bytes > 0:
-                percent = downloaded_bytes / total_bytes * 100
-                percent_rounded = round(percent, 1)
-                downloaded_mb = downloaded_bytes / (1024 * 1024)
-                total_mb = total_bytes / (1024 * 1024)
-                bar = '⬢' * int(20 * percent / 100) + '⬡' * (20 - int(20 * percent / 100))
-                if (current_time - last_update_time.get(user_id, 0) > 1.0 and
-                    (last_percent.get(user_id) is None or abs(percent_rounded - last_percent[user_id]) >= 1)):
-                    last_update_time[user_id] = current_time
-                    last_percent[user_id] = percent_rounded
-                    await safe_edit_message(context, user_id, message_id,
-                        f"⏬ **Downloading...**\n\n{bar} **{percent_rounded}%**\n\n📊 **Progress:** `{downloaded_mb:.1f}MB / {total_mb:.1f}MB`\n⚡ **Speed:** `{speed / (1024*1024):.1f} MB/s`")
-        elif d.get('status') == 'finished':
-            await safe_edit_message(context, user_id, message_id, "✅ Download finished, processing...")
-    except Exception as e:
-        logger.error(f"Progress hook error: {e}")
+def render_progress(d):
+    """Build the status text for a yt-dlp progress dict, or None if there is nothing to show"""
+    if d.get('status') == 'downloading':
+        downloaded_bytes = d.get('downloaded_bytes', 0)
+        total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate')
+        speed = d.get('speed') or 0
+        if total_bytes and total_bytes > 0:
+            percent = min(downloaded_bytes / total_bytes * 100, 100)
+            percent_rounded = round(percent, 1)
+            downloaded_mb = downloaded_bytes / (1024 * 1024)
+            total_mb = total_bytes / (1024 * 1024)
+            bar = '⬢' * int(20 * percent / 100) + '⬡' * (20 - int(20 * percent / 100))
+            return (f"⏬ **Downloading...**\n\n{bar} **{percent_rounded}%**\n\n📊 **Progress:** `{downloaded_mb:.1f}MB / {total_mb:.1f}MB`\n⚡ **Speed:** `{speed / (1024*1024):.1f} MB/s`")
+    elif d.get('status') == 'finished':
+        return "✅ Download finished, processing..."
+    return None
 
-async def get_available_formats(url, max_retries=2):
-    """Get available formats for a video with robust error handling"""
-    
-    # Check network connectivity first
-    if not check_network():
-        raise Exception("Network connectivity issues detected")
-    
-    # Try different strategies
-    strategies = [
-        {
-            'name': 'web_basic',
-            'opts': {
-                'quiet': True,
-                'listformats': True,
-                'user_agent': random.choice(USER_AGENTS),
-                'socket_timeout': 30,
-                'force_ipv4': True,
-                'extractor_args': {
-                    'youtube': {
-                        'player_client': ['web'],
-                        'skip': ['hls', 'dash'],
-                    }
+class ProgressTracker:
+    """Holds the latest progress of one job; a single updater task flushes it to the status message"""
+
+    __slots__ = ('context', 'chat_id', 'message_id', 'latest', 'last_text', 'task')
+
+    def __init__(self, context, chat_id, message_id):
+        self.context = context
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.latest = None
+        self.last_text = None
+        self.task = None
+
+    def hook(self, d):
+        """yt-dlp progress hook; runs on the download thread and only overwrites the slot"""
+        self.latest = d
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def render(self):
+        return render_progress(self.latest) if self.latest is not None else None
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(PROGRESS_INTERVAL)
+                text = self.render()
+                if text and text != self.last_text:
+                    self.last_text = text
+                    await safe_edit_message(self.context, self.chat_id, self.message_id, text)
+        except Exception as e:
+            logger.error(f"Progress updater error: {e}")
+
+# Extraction strategies, tried in order
+EXTRACTION_STRATEGIES = [
+    {
+        'name': 'web_basic',
+        'opts': {
+            'quiet': True,
+            'listformats': True,
+            'socket_timeout': 30,
+            'force_ipv4': True,
+            'extractor_args': {
+                'youtube': {
+                    'player_client': ['web'],
+                    'skip': ['hls', 'dash'],
                 }
             }
-        },
-        {
-            'name': 'android_basic',
-            'opts': {
-                'quiet': True,
-                'listformats': True,
-                'user_agent': random.choice(USER_AGENTS),
-                'socket_timeout': 30,
-                'force_ipv4': True,
-                'extractor_args': {
-                    'youtube': {
-                        'player_client': ['android'],
-                        'skip': ['hls'],
-                    }
+        }
+    },
+    {
+        'name': 'android_basic',
+        'opts': {
+            'quiet': True,
+            'listformats': True,
+            'socket_timeout': 30,
+            'force_ipv4': True,
+            'extractor_args': {
+                'youtube': {
+                    'player_client': ['android'],
+                    'skip': ['hls'],
                 }
             }
-        },
-        {
-            'name': 'ios_fallback',
-            'opts': {
-                'quiet': True,
-                'listformats': True,
-                'user_agent': random.choice(USER_AGENTS),
-                'socket_timeout': 45,
-                'force_ipv4': True,
-                'extractor_args': {
-                    'youtube': {
-                        'player_client': ['ios'],
-                    }
+        }
+    },
+    {
+        'name': 'ios_fallback',
+        'opts': {
+            'quiet': True,
+            'listformats': True,
+            'socket_timeout': 45,
+            'force_ipv4': True,
+            'extractor_args': {
+                'youtube': {
+                    'player_client': ['ios'],
                 }
             }
         }
-    ]
-    
-    for strategy in strategies:
-        for attempt in range(max_retries):
-            try:
-                logger.info(f"Trying strategy: {strategy['name']}, attempt: {attempt + 1}")
-                
-                opts = strategy['opts'].copy()
-                
-                # Add cookies if available
-                if os.path.exists('cookies.txt'):
-                    opts['cookiefile'] = 'cookies.txt'
-                
-                # Add proxy for some attempts
-                proxy = os.getenv('PROXY_URL')
-                if proxy and attempt > 0:
-                    opts['proxy'] = proxy
-                
-                with yt_dlp.YoutubeDL(opts) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    formats = info.get('formats', [])
-                    
-                    if not formats:
-                        logger.warning(f"No formats found with {strategy['name']}")
-                        continue
-                    
-                    # Filter formats more carefully
-                    video_formats = []
-                    audio_formats = []
-                    
-                    for f in formats:
-                        # Skip image formats explicitly
-                        if f.get('vcodec') == 'none' and f.get('acodec') == 'none':
-                            continue
-                        if f.get('format_note') and 'image' in f.get('format_note', '').lower():
-                            continue
-                        
-                        # Audio formats
-                        if f.get('acodec') != 'none' and f.get('vcodec') == 'none':
-                            audio_formats.append(f)
-                        # Video formats with audio
-                        elif f.get('vcodec') != 'none' and f.get('acodec') != 'none':
-                            video_formats.append(f)
-                        # Video-only formats
-                        elif f.get('vcodec') != 'none':
-                            video_formats.append(f)
-                    
-                    if video_formats or audio_formats:
-                        logger.info(f"✅ Found formats using {strategy['name']}: {len(video_formats)} video, {len(audio_formats)} audio")
-                        return info, video_formats, audio_formats, strategy['name']
-                        
-            except Exception as e:
-                error_msg = str(e).lower()
-                logger.warning(f"Strategy {strategy['name']} attempt {attempt + 1} failed: {e}")
-                
-                # Handle specific DNS errors
-                if "failed to resolve" in error_msg or "name or service not known" in error_msg:
-                    logger.error("DNS resolution failed - network issues detected")
-                    await asyncio.sleep(random.uniform(3, 6))
-                    continue
-                
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(random.uniform(2, 4))
-                continue
-    
-    raise Exception("Unable to extract video formats - video may be restricted, private, or unavailable")
+    }
+]
 
-def get_smart_format_string(format_type, quality, video_formats, audio_formats):
-    """Generate smart format string based on actually available formats"""
-    
-    if format_type == 'mp3' or format_type == 'audio':
-        # For audio, prefer standalone audio formats
-        if audio_formats:
-            # Sort by quality (bitrate or format preference)
-            best_audio_formats = []
-            for fmt in audio_formats:
-                ext = fmt.get('ext', '')
-                if ext in ['m4a', 'mp3', 'aac']:
-                    best_audio_formats.append(f"format_id={fmt['format_id']}")
-            
-            if best_audio_formats:
-                return '/'.join(best_audio_formats[:3]) + '/bestaudio/best'
-            else:
-                return 'bestaudio/best'
-        else:
-            # Fallback to video with audio
-            return 'best[height<=720]/best/worst'
+def get_strategy_player_client(strategy_name):
+    """Return the YouTube player_client list used by a named strategy"""
+    for strategy in EXTRACTION_STRATEGIES:
+        if strategy['name'] == strategy_name:
+            return list(strategy['opts']['extractor_args']['youtube'].get('player_client', []))
+    return None
+
+def get_info_expiry(info):
+    """Earliest expiry timestamp of the stream URLs in a probed info dict"""
+    expiry = None
+    for f in info.get('formats') or []:
+        query = urllib.parse.urlparse(f.get('url') or '').query
+        expire = urllib.parse.parse_qs(query).get('expire')
+        if expire and expire[0].isdigit():
+            expire = int(expire[0])
+            expiry = expire if expiry is None else min(expiry, expire)
+    if expiry is None:
+        expiry = info.get('epoch', time.time()) + INFO_MAX_AGE
+    return expiry
+
+def is_info_fresh(info):
+    """Check whether a probed info dict can still be used for downloading"""
+    return bool(info) and get_info_expiry(info) - time.time() > INFO_EXPIRY_MARGIN
+
+def split_formats(formats):
+    """Split yt-dlp formats into (video_formats, audio_formats), dropping images"""
+    video_formats = []
+    audio_formats = []
     
-    else:  # MP4
-        if not video_formats:
-            return 'best/worst'
-        
-        # Build format string based on available qualities
-        format_options = []
+    for f in formats:
+        # Skip image formats explicitly
+        if f.get('vcodec') == 'none' and f.get('acodec') == 'none':
+            continue
+        if f.get('format_note') and 'image' in f.get('format_note', '').lower():
+            continue
         
-        if quality == 'best':
-            # Get best available formats
-            for fmt in video_formats[:5]:  # Top 5 formats
-                if fmt.get('height'):
-                    format_options.append(f"format_id={fmt['format_id']}")
-            
-            format_options.extend(['best[ext=mp4]', 'best[ext=webm]', 'best'])
-        else:
-            # Quality-specific
-            quality_num = quality.replace('p', '')
-            
-            # Find formats close to requested quality
-            suitable_formats = []
-            for fmt in video_formats:
-                fmt_height = fmt.get('height', 0)
-                if fmt_height and abs(fmt_height - int(quality_num)) <= 100:
-                    suitable_formats.append(f"format_id={fmt['format_id']}")
-            
-            if suitable_formats:
-                format_options.extend(suitable_formats[:3])
-            
-            # Add fallback options
-            format_options.extend([
-                f'best[height<={quality_num}][ext=mp4]',
-                f'best[height<={quality_num}]',
-                f'worst[height>={int(quality_num)//2}]',
-                'best[height<=720]',
-                'best'
-            ])
-        
-        return '/'.join(format_options[:8])  # Limit to prevent overly long format strings
+        # Audio formats
+        if f.get('acodec') != 'none' and f.get('vcodec') == 'none':
+            audio_formats.append(f)
+        # Video formats with audio
+        elif f.get('vcodec') != 'none' and f.get('acodec') != 'none':
+            video_formats.append(f)
+        # Video-only formats
+        elif f.get('vcodec') != 'none':
+            video_formats.append(f)
+    
+    return video_formats, audio_formats
+
+def extract_info_blocking(opts, url):
+    """Run a metadata-only yt-dlp extraction (called on an extraction worker)"""
+    import yt_dlp
+    with cookie_manager.checkout() as cookiefile:
+        if cookiefile:
+            opts = dict(opts, cookiefile=cookiefile)
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            return ydl.extract_info(url, download=False)
+
+# Strategy selection settings
+STRATEGY_WINDOW = int(os.getenv("STRATEGY_WINDOW", "20"))  # recent outcomes kept per strategy
+STRATEGY_FAILURE_THRESHOLD = int(os.getenv("STRATEGY_FAILURE_THRESHOLD", "3"))  # consecutive failures that open the circuit
+STRATEGY_COOLDOWN = int(os.getenv("STRATEGY_COOLDOWN", "300"))
+STRATEGY_RACE = os.getenv("STRATEGY_RACE", "false").lower() in ('1', 'true', 'yes')
+
+class StrategyStats:
+    __slots__ = ('outcomes', 'failures', 'open_until')
+
+    def __init__(self):
+        self.outcomes = deque(maxlen=STRATEGY_WINDOW)  # (ok, latency)
+        self.failures = 0
+        self.open_until = 0.0
+
+    def expected_cost(self):
+        """Expected seconds until a successful probe: mean latency over smoothed success rate"""
+        successes = sum(1 for ok, _ in self.outcomes if ok)
+        rate = (successes + 1) / (len(self.outcomes) + 2)
+        latency = sum(l for _, l in self.outcomes) / len(self.outcomes) if self.outcomes else 5.0
+        return latency / rate
+
+class StrategySelector:
+    """Orders extraction strategies by recent success rate and latency, per extractor,
+    and circuit-breaks strategies that keep failing"""
+
+    def __init__(self, strategies):
+        self.strategies = strategies
+        self.stats = {}  # (extractor, strategy name) -> StrategyStats; extractor '*' aggregates all
+
+    def _get(self, extractor, name):
+        key = (extractor, name)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = StrategyStats()
+        return stats
+
+    def order(self, extractor):
+        """Strategies to try, best first; open circuits go last so a request never runs out of options"""
+        now = time.monotonic()
+
+        def rank(strategy):
+            stats = self._get(extractor, strategy['name'])
+            if not stats.outcomes:
+                stats = self._get('*', strategy['name'])
+            return (stats.open_until > now, stats.expected_cost())
+
+        return sorted(self.strategies, key=rank)
+
+    def is_open(self, extractor, name):
+        return self._get(extractor, name).open_until > time.monotonic()
+
+    def record(self, extractor, name, ok, latency):
+        probes_total.inc(name, 'ok' if ok else 'failed')
+        for stats in (self._get(extractor, name), self._get('*', name)):
+            stats.outcomes.append((ok, latency))
+            if ok:
+                stats.failures = 0
+                stats.open_until = 0.0
+            else:
+                stats.failures += 1
+                if stats.failures >= STRATEGY_FAILURE_THRESHOLD:
+                    stats.open_until = time.monotonic() + STRATEGY_COOLDOWN
+        if not ok and self.is_open(extractor, name):
+            logger.warning(f"🔌 Strategy {name} circuit open for {extractor} ({STRATEGY_COOLDOWN}s)")
+
+strategy_selector = StrategySelector(EXTRACTION_STRATEGIES)
+
+def is_dns_error(error):
+    error_msg = str(error).lower()
+    return "failed to resolve" in error_msg or "name or service not known" in error_msg
+
+async def probe_with_strategy(url, strategy, attempt, extractor):
+    """One probe attempt; records the outcome for the strategy selector"""
+    logger.info(f"Trying strategy: {strategy['name']}, attempt: {attempt + 1}")
+    
+    opts = copy.deepcopy(strategy['opts'])
+    opts['user_agent'] = random.choice(USER_AGENTS)
+    if DOWNLOAD_PROFILE == 'fast':
+        allow_hls(opts)
+    
+    # Add proxy for some attempts
+    proxy = os.getenv('PROXY_URL')
+    if proxy and attempt > 0:
+        opts['proxy'] = proxy
+    
+    started = time.monotonic()
+    try:
+        info = await extraction_pool.run(extract_info_blocking, opts, url,
+                                         label=f"Probe {strategy['name']}#{attempt + 1}")
+        info.setdefault('epoch', int(time.time()))
+        video_formats, audio_formats = split_formats(info.get('formats', []))
+        if not (video_formats or audio_formats):
+            raise Exception(f"No formats found with {strategy['name']}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # DNS trouble says nothing about the strategy itself
+        if not is_dns_error(e):
+            strategy_selector.record(extractor, strategy['name'], False, time.monotonic() - started)
+        raise
+    
+    strategy_selector.record(extractor, strategy['name'], True, time.monotonic() - started)
+    logger.info(f"✅ Found formats using {strategy['name']}: {len(video_formats)} video, {len(audio_formats)} audio")
+    return info, video_formats, audio_formats, strategy['name']
+
+async def race_strategies(url, strategies, extractor):
+    """Probe with several strategies at once; the first success wins and the rest are cancelled"""
+    tasks = [asyncio.create_task(probe_with_strategy(url, strategy, 0, extractor)) for strategy in strategies]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                return await next_done
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Raced probe failed: {e}")
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def get_available_formats(url, max_retries=2):
+    """Get available formats for a video with robust error handling"""
+    
+    # Network down: wait for the health monitor to see it come back instead of failing right away
+    if not health.online and not await health.wait_online(HEALTH_OFFLINE_WAIT):
+        raise Exception("Network connectivity issues detected")
+    
+    extractor = get_video_key(url).split(':', 1)[0]
+    strategies = strategy_selector.order(extractor)
+    raced = set()
+    
+    if STRATEGY_RACE:
+        contenders = [s for s in strategies if not strategy_selector.is_open(extractor, s['name'])][:2]
+        if len(contenders) == 2:
+            result = await race_strategies(url, contenders, extractor)
+            if result:
+                return result
+            raced = {s['name'] for s in contenders}
+    
+    for strategy in strategies:
+        for attempt in range(1 if strategy['name'] in raced else 0, max_retries):
+            try:
+                return await probe_with_strategy(url, strategy, attempt, extractor)
+                        
+            except asyncio.CancelledError:
+                raise
+                        
+            except Exception as e:
+                logger.warning(f"Strategy {strategy['name']} attempt {attempt + 1} failed: {e}")
+                
+                # Handle specific DNS errors
+                if is_dns_error(e):
+                    logger.error("DNS resolution failed - network issues detected")
+                    await asyncio.sleep(random.uniform(3, 6))
+                    continue
+                
+                # A strategy whose circuit just opened isn't worth another attempt
+                if strategy_selector.is_open(extractor, strategy['name']):
+                    break
+                
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(random.uniform(2, 4))
+                continue
+    
+    raise Exception("Unable to extract video formats - video may be restricted, private, or unavailable")
+
+@functools.lru_cache(maxsize=1)
+def get_extractor_classes():
+    """yt-dlp extractors minus Generic, loaded on first use"""
+    from yt_dlp.extractor import gen_extractor_classes
+    return [ie for ie in gen_extractor_classes() if ie.ie_key() != 'Generic']
+
+@functools.lru_cache(maxsize=4096)
+def get_url_extractor(url):
+    """The yt-dlp extractor class that claims a URL, or None for generic pages"""
+    for ie in get_extractor_classes():
+        if ie.suitable(url):
+            return ie
+    return None
+
+def strip_playlist_query(url):
+    """The URL without its playlist parameters (list=, index=)"""
+    parsed = urllib.parse.urlparse(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True) if k not in ('list', 'index')]
+    return parsed._replace(query=urllib.parse.urlencode(query)).geturl()
+
+@functools.lru_cache(maxsize=4096)
+def get_video_key(url):
+    """Canonical 'Extractor:video_id' key for a URL, resolved offline"""
+    url = url.strip()
+    ie = get_url_extractor(url)
+    # Like noplaylist: a link naming both a video and a list (watch?v=...&list=...) means the video,
+    # so key it the way the single-video extractor would rather than on the playlist ID
+    if ie is not None and getattr(ie, '_RETURN_TYPE', None) != 'video' \
+            and urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('v'):
+        url = strip_playlist_query(url)
+        ie = get_url_extractor(url)
+    video_id = ie.get_temp_id(url) if ie else None
+    if video_id:
+        return f"{ie.ie_key()}:{video_id}"
+    return f"url:{url}"
+
+def is_playlist_url(url):
+    """Offline check whether a link names a playlist or album rather than one video"""
+    ie = get_url_extractor(url.strip())
+    return_type = getattr(ie, '_RETURN_TYPE', None)
+    if return_type == 'playlist':
+        return True
+    # Extractors that return either (YouTube tabs, posts) count only for list links; an explicit video wins, as with noplaylist
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+    return return_type == 'any' and 'list' in query and 'v' not in query
+
+# Metadata cache settings
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "256"))
+# Upper bound on entry lifetime; entries also expire with their stream URLs
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", "3600"))
+METADATA_CACHE_DB = os.getenv("METADATA_CACHE_DB")  # backend spec, e.g. "cache/metadata.db", to persist across restarts
+
+class MetadataCache:
+    """TTL/LRU cache of probe results keyed by extractor and video ID"""
+
+    def __init__(self, max_size, ttl, db_path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, (info, video_formats, audio_formats, strategy))
+        self.inflight = {}  # key -> asyncio.Task of the probe currently running
+        self.waiters = {}  # key -> number of callers awaiting the in-flight probe
+        self.store = create_backend(db_path) if db_path else None
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'disk_hits': 0, 'prefetches': 0}
+
+    def get(self, key):
+        """In-memory lookup; the persistent store is only read by the probe task"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self.entries.move_to_end(key)
+                return entry[1]
+            del self.entries[key]
+        return None
+
+    async def _load(self, key):
+        stored = await self.store.aget("metadata", key)
+        if stored is None:
+            return None
+        value, expires = stored
+        info = value['info']
+        result = (info, *split_formats(info.get('formats') or []), value['strategy'])
+        self._remember(key, result, expires)
+        self.stats['disk_hits'] += 1
+        return result
+
+    def put(self, key, result):
+        info, _, _, strategy = result
+        expires = min(time.time() + self.ttl, get_info_expiry(info) - INFO_EXPIRY_MARGIN)
+        if expires <= time.time():
+            return
+        self._remember(key, result, expires)
+        if self.store:
+            write_behind(asyncio.to_thread(self._persist, key, info, strategy, expires), f"metadata {key}")
+
+    def _persist(self, key, info, strategy, expires):
+        import yt_dlp
+        sanitized = yt_dlp.YoutubeDL.sanitize_info(copy.deepcopy(info))
+        self.store.set("metadata", key, {'info': sanitized, 'strategy': strategy}, expires, max_entries=self.max_size)
+
+    def _remember(self, key, result, expires):
+        self.entries[key] = (expires, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def _fetch(self, key, url, probe):
+        if self.store:
+            try:
+                result = await self._load(key)
+            except Exception as e:
+                logger.warning(f"Failed to read persisted metadata for {key}: {e}")
+                result = None
+            if result is not None:
+                return result
+        result = await probe(url)
+        self.put(key, result)
+        return result
+
+    async def get_or_probe(self, url, probe):
+        """Return cached probe results for url, running (or joining) a single probe on a miss"""
+        key = get_video_key(url)
+        result = self.get(key)
+        if result is not None:
+            self.stats['hits'] += 1
+            logger.info(f"📦 Metadata cache hit for {key}")
+            return result
+
+        task = self.inflight.get(key)
+        if task is not None:
+            self.stats['coalesced'] += 1
+            logger.info(f"📦 Joining in-flight probe for {key}")
+        else:
+            self.stats['misses'] += 1
+            task = self._start(key, url, probe)
+        # Shield so one waiter being cancelled doesn't abort the probe for the others
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[key] -= 1
+            if not self.waiters[key]:
+                del self.waiters[key]
+
+    def _start(self, key, url, probe):
+        task = asyncio.create_task(self._fetch(key, url, probe))
+        self.inflight[key] = task
+        task.add_done_callback(lambda t: self.inflight.pop(key, None))
+        return task
+
+    def prefetch(self, url, probe):
+        """Start a probe in the background unless the result is cached or already being probed.
+        Returns the probe task, or None if there was nothing to do"""
+        key = get_video_key(url)
+        if key in self.inflight or self.get(key) is not None:
+            return None
+        self.stats['prefetches'] += 1
+        return self._start(key, url, probe)
+
+    def cancel_probe(self, url):
+        """Cancel an in-flight probe, unless a caller is waiting for it"""
+        key = get_video_key(url)
+        task = self.inflight.get(key)
+        if task is not None and not self.waiters.get(key):
+            task.cancel()
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL, METADATA_CACHE_DB)
+
+# Speculative prefetch settings
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() in ('1', 'true', 'yes')
+PREFETCH_PER_USER = int(os.getenv("PREFETCH_PER_USER", "2"))
+PREFETCH_TIMEOUT = int(os.getenv("PREFETCH_TIMEOUT", "120"))  # cancel if no format is picked by then
+
+URL_PATTERN = re.compile(r'https?://[^\s<>"]+', re.IGNORECASE)
+# Links pasted without a scheme (youtube.com/watch?v=..., youtu.be/...): a host name and a path,
+# starting a word so e-mail addresses and the middle of other links don't count
+BARE_URL_PATTERN = re.compile(r'(?<![^\s(<\[\'"])(?:[a-z0-9-]+\.)+[a-z]{2,}(?::\d+)?/[^\s<>"]*', re.IGNORECASE)
+LINK_PATTERN = re.compile(f"{URL_PATTERN.pattern}|{BARE_URL_PATTERN.pattern}", re.IGNORECASE)
+
+def extract_urls(text):
+    """Distinct links in a message, in the order they appear; scheme-less ones get https://"""
+    urls = []
+    for match in LINK_PATTERN.finditer(text):
+        url = match.group().rstrip('.,;:!?)]}\'')
+        if not URL_PATTERN.match(url):
+            url = f"https://{url}"
+        if urllib.parse.urlparse(url).netloc and url not in urls:
+            urls.append(url)
+    return urls
+
+class Prefetcher:
+    """Starts the metadata probe while the user is still choosing a format.
+    The result lands in the metadata cache, where download_video picks it up"""
+
+    def __init__(self, per_user, timeout):
+        self.per_user = per_user
+        self.timeout = timeout
+        self.pending = {}  # session token -> (user_id, url, probe task, cancel timer)
+        self.counts = {}  # user_id -> speculative probes still running
+
+    def start(self, session):
+        # Only URLs a dedicated extractor recognises; generic pages wait for a real request
+        if get_video_key(session.url).startswith('url:'):
+            return
+        if self.counts.get(session.user_id, 0) >= self.per_user:
+            return
+        # Speculative work only fills spare extraction capacity
+        if extraction_pool.pending >= extraction_pool.max_queue // 2:
+            return
+        task = metadata_cache.prefetch(session.url, get_available_formats)
+        if task is None:
+            return
+        timer = asyncio.get_running_loop().call_later(self.timeout, self.discard, session.token)
+        self.pending[session.token] = (session.user_id, session.url, task, timer)
+        self.counts[session.user_id] = self.counts.get(session.user_id, 0) + 1
+        task.add_done_callback(lambda t: self._release(session.token))
+        logger.info(f"🔮 Prefetching metadata for {session.url}")
+
+    def _release(self, token):
+        entry = self.pending.pop(token, None)
+        if entry is None:
+            return
+        user_id, _, _, timer = entry
+        timer.cancel()
+        self.counts[user_id] -= 1
+        if not self.counts[user_id]:
+            del self.counts[user_id]
+
+    def claim(self, token):
+        """The user picked a format; let the probe run to completion"""
+        self._release(token)
+
+    def discard(self, token):
+        """The user went away or cancelled; drop the speculative probe"""
+        entry = self.pending.get(token)
+        if entry is None:
+            return
+        self._release(token)
+        metadata_cache.cancel_probe(entry[1])
+        logger.info(f"🔮 Dropped unused prefetch for {entry[1]}")
+
+prefetcher = Prefetcher(PREFETCH_PER_USER, PREFETCH_TIMEOUT)
+
+# Telegram file_id result cache settings
+# Backend spec; defaults to the shared STATE_BACKEND when one is configured
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB", STATE_BACKEND if STATE_BACKEND != "memory" else "cache/results.db")
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "20000"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(30 * 24 * 3600)))
+
+class ResultCache:
+    """Persistent cache of uploaded Telegram file_ids keyed by (video, format, quality)"""
+
+    def __init__(self, db_path, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = create_backend(db_path)
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'invalidations': 0}
+
+    @staticmethod
+    def make_key(url, format_type, quality):
+        return f"{get_video_key(url)}|{format_type}|{quality}"
+
+    async def get(self, key):
+        stored = await self.store.aget("results", key)
+        if stored is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return stored[0]
+
+    async def put(self, key, document, filename):
+        await self.store.aset("results", key, {
+            'file_id': document.file_id,
+            'file_unique_id': document.file_unique_id,
+            'file_size': document.file_size,
+            'filename': filename,
+        }, time.time() + self.ttl, max_entries=self.max_size)
+        self.stats['stores'] += 1
+
+    async def invalidate(self, key, reason=""):
+        """Forget a file_id Telegram no longer accepts"""
+        await self.store.adelete("results", key)
+        self.stats['invalidations'] += 1
+        logger.warning(f"🗑️ Invalidated cached result {key}: {reason}")
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+result_cache = ResultCache(RESULT_CACHE_DB, RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+async def send_cached_result(context: CallbackContext, user_id, message_id, cache_key, download_type, quality_label):
+    """Re-send a previously uploaded file by file_id; returns False on a cache miss or stale ID"""
+    cached = await result_cache.get(cache_key)
+    if not cached:
+        return False
+    try:
+        await asyncio.wait_for(
+            context.bot.send_document(chat_id=user_id, document=cached['file_id']),
+            timeout=30
+        )
+    except BadRequest as e:
+        # Telegram rejected the file_id (expired, deleted, or from another bot)
+        await result_cache.invalidate(cache_key, str(e))
+        return False
+    except (TelegramError, asyncio.TimeoutError) as e:
+        # Timeouts, network errors, flood limits: the cached entry is fine, this attempt isn't
+        logger.warning(f"Re-sending cached {cache_key} failed, downloading instead: {e!r}")
+        return False
+    logger.info(f"⚡ Served {cache_key} from result cache (hit rate {result_cache.hit_rate():.0%})")
+    
+    size_mb = (cached.get('file_size') or 0) / (1024 * 1024)
+    try:
+        await asyncio.wait_for(
+            context.bot.send_message(
+                chat_id=user_id,
+                text=f"✅ **Download completed!**\n\n"
+                     f"📋 **Format:** {download_type}\n"
+                     f"📊 **Quality:** {quality_label}\n"
+                     f"📦 **Size:** {size_mb:.1f}MB\n"
+                     f"⚡ Delivered instantly from cache",
+                parse_mode='Markdown'
+            ),
+            timeout=30
+        )
+    except (TelegramError, asyncio.TimeoutError) as e:
+        # The file itself arrived, so the job still counts as served
+        logger.warning(f"Completion message after cached send failed: {e!r}")
+    try:
+        await context.bot.delete_message(chat_id=user_id, message_id=message_id)
+    except:
+        pass
+    return True
+
+# Codec preferences: H.264 + AAC play everywhere and merge into mp4 without re-encoding
+VIDEO_CODEC_SCORES = {'h264': 30, 'vp9': 12, 'h265': 8, 'av1': 5}
+AUDIO_CODEC_SCORES = {'aac': 20, 'mp3': 15, 'opus': 10, 'vorbis': 5}
+CODEC_FAMILIES = (
+    ('avc', 'h264'), ('h264', 'h264'), ('vp09', 'vp9'), ('vp9', 'vp9'), ('av01', 'av1'),
+    ('hev', 'h265'), ('hvc', 'h265'), ('mp4a', 'aac'), ('aac', 'aac'), ('opus', 'opus'),
+    ('mp3', 'mp3'), ('vorbis', 'vorbis'),
+)
+
+def get_codec_family(codec):
+    """Codec family for scoring. 'none' means yt-dlp reported no such stream; a codec it didn't
+    report at all is 'unknown', and counts as present, as in split_formats"""
+    if not codec:
+        return 'unknown'
+    codec = codec.lower()
+    for prefix, family in CODEC_FAMILIES:
+        if codec.startswith(prefix):
+            return family
+    return codec
+
+def has_audio(fmt):
+    """Whether a video format carries its own audio and needs no merge"""
+    return get_codec_family(fmt.get('acodec')) != 'none'
+
+def size_penalty(size, extra, limit):
+    if size < 0:
+        return -5  # unknown size: usable, but a known fit is better
+    return -1000 if limit and size + extra > limit else 0
+
+def score_audio_formats(formats, target, duration, limit):
+    """Score standalone audio formats; sources the target can remux without re-encoding win"""
+    copy_codecs = tuple(get_codec_family(c) for c in AUDIO_TARGETS[target]['copy_codecs']) if target in AUDIO_TARGETS else ()
+    scores = []
+    for f in formats:
+        acodec = get_codec_family(f.get('acodec'))
+        score = AUDIO_CODEC_SCORES.get(acodec, 0)
+        score += 30 if acodec in copy_codecs else 0
+        score += 10 if f.get('ext') == 'm4a' else 0
+        score += min(f.get('tbr') or f.get('abr') or 0, 192) / 10
+        score -= 5 if (f.get('protocol') or '').startswith('m3u8') else 0
+        score += size_penalty(estimate_format_size(f, duration) or -1, 0, limit)
+        scores.append(score)
+    return scores
+
+def score_video_formats(formats, target_height, duration, merge_audio_size, limit):
+    """Score video formats on resolution fit, codec, muxing, fps, bitrate and size budget"""
+    scores = []
+    for f in formats:
+        height = f.get('height') or 0
+        muxed = has_audio(f)
+        if not height:
+            score = -50
+        elif target_height:
+            # As close to the requested height as possible, going over is worse than going under
+            distance = target_height - height
+            score = 100 - (distance / 10 if distance >= 0 else -distance / 2)
+        else:
+            score = height / 10
+        score += VIDEO_CODEC_SCORES.get(get_codec_family(f.get('vcodec')), 0)
+        score += 25 if muxed else 0  # no FFmpeg merge needed
+        score += 10 if f.get('ext') == 'mp4' else 0
+        score += min(f.get('fps') or 0, 60) / 6
+        score += min(f.get('tbr') or f.get('abr') or 0, 10000) / 1000
+        score -= 5 if (f.get('protocol') or '').startswith('m3u8') else 0
+        score += size_penalty(estimate_format_size(f, duration) or -1, 0 if muxed else merge_audio_size, limit)
+        scores.append(score)
+    return scores
+
+def best_index(scores):
+    return max(range(len(scores)), key=scores.__getitem__)
+
+def select_format(format_type, quality, video_formats, audio_formats, duration=None, size_limit=None):
+    """Rank the probed formats and return an exact format spec ('id' or 'video_id+audio_id'),
+    followed by a generic fallback for retries that re-extract with a different client"""
+    audio_choice = None
+    if audio_formats:
+        audio_scores = score_audio_formats(audio_formats, format_type, duration, size_limit)
+        audio_choice = audio_formats[best_index(audio_scores)]
+
+    if format_type in AUDIO_TARGETS or format_type == 'audio':
+        if audio_choice:
+            logger.info(f"🎯 Selected audio {audio_choice['format_id']} ({audio_choice.get('acodec')}, {audio_choice.get('abr') or '?'}kbps)")
+            return f"{audio_choice['format_id']}/bestaudio/best"
+        # Fallback to video with audio
+        return 'best[height<=720]/best/worst'
+
+    if not video_formats:
+        return 'best/worst'
+
+    target_height = None if quality == 'best' else int(quality.replace('p', ''))
+    merge_audio_size = estimate_format_size(audio_choice, duration) or 0 if audio_choice else 0
+    video_scores = score_video_formats(video_formats, target_height, duration, merge_audio_size, size_limit)
+    video_choice = video_formats[best_index(video_scores)]
+
+    if has_audio(video_choice) or not audio_choice:
+        exact = video_choice['format_id']
+    else:
+        exact = f"{video_choice['format_id']}+{audio_choice['format_id']}"
+    logger.info(f"🎯 Selected {exact} ({video_choice.get('height') or '?'}p {video_choice.get('vcodec')}, "
+                f"score {max(video_scores):.1f} of {len(video_formats)} formats)")
+    fallback = f"best[height<={target_height}]/best" if target_height else 'best'
+    return f"{exact}/{fallback}"
 
 async def choose_quality(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
-    user_id = query.message.chat_id
-    format_type = query.data
-    url = user_links.get(user_id)
-    if not url:
+    format_type, token = parse_callback(query.data)
+    session = await sessions.get(token)
+    if not session:
         await query.edit_message_text("❌ URL not found. Please send it again.")
         return
-    user_formats[user_id] = format_type
+    session.format_type = format_type
+    await sessions.save(session)
+    prefetcher.claim(token)
     
-    # Check if user wants MP3 but FFmpeg is not available
-    if format_type == 'mp3' and not FFMPEG_AVAILABLE:
+    # Check if user wants converted audio but FFmpeg is not available
+    if format_type in AUDIO_TARGETS and not FFMPEG_AVAILABLE:
         await query.edit_message_text(
-            "⚠️ **MP3 conversion not available**\n\n"
+            f"⚠️ **{format_type.upper()} conversion not available**\n\n"
             "FFmpeg is not installed on this server. I can download the audio in its original format (usually M4A or WebM).\n\n"
             "Would you like to continue with the original audio format?",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Yes, download original audio", callback_data='audio_original')],
-                [InlineKeyboardButton("❌ Cancel", callback_data='cancel')]
+                [InlineKeyboardButton("✅ Yes, download original audio", callback_data=f'audio_original:{token}')],
+                [InlineKeyboardButton("❌ Cancel", callback_data=f'cancel:{token}')]
             ])
         )
         return
     
-    if format_type == 'mp3':
-        await download_video(update, context)
+    if format_type in AUDIO_TARGETS:
+        await download_video(query, context, session, 'best')
     else:
         keyboard = [
-            [InlineKeyboardButton("360p", callback_data='360'), InlineKeyboardButton("480p", callback_data='480')],
-            [InlineKeyboardButton("720p", callback_data='720'), InlineKeyboardButton("1080p", callback_data='1080')],
-            [InlineKeyboardButton("Best Available", callback_data='best')]
+            [InlineKeyboardButton("360p", callback_data=f'360:{token}'), InlineKeyboardButton("480p", callback_data=f'480:{token}')],
+            [InlineKeyboardButton("720p", callback_data=f'720:{token}'), InlineKeyboardButton("1080p", callback_data=f'1080:{token}')],
+            [InlineKeyboardButton("Best Available", callback_data=f'best:{token}')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text("Choose video quality:", reply_markup=reply_markup)
 
-def get_enhanced_ydl_opts(output_file, format_spec, postprocessors, my_hook):
+# Download profile: "standard" uses one connection per file, "fast" downloads
+# DASH/HLS fragments in parallel and no longer skips HLS formats
+DOWNLOAD_PROFILE = os.getenv("DOWNLOAD_PROFILE", "standard").lower()
+FRAGMENT_CONCURRENCY = int(os.getenv("FRAGMENT_CONCURRENCY", "4"))
+HTTP_CHUNK_SIZE = int(float(os.getenv("HTTP_CHUNK_SIZE_MB", "10")) * 1024 * 1024)
+# Total download bandwidth shared by all running jobs in MB/s, 0 = unlimited
+BANDWIDTH_BUDGET = int(float(os.getenv("BANDWIDTH_BUDGET_MB", "0")) * 1024 * 1024)
+MIN_BUFFER_SIZE = 16 * 1024
+MAX_BUFFER_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 1024 * 1024
+
+def allow_hls(opts):
+    """Drop 'hls' from the YouTube skip list so fragmented formats are offered"""
+    youtube_args = opts.get('extractor_args', {}).get('youtube', {})
+    if 'skip' in youtube_args:
+        youtube_args['skip'] = [s for s in youtube_args['skip'] if s != 'hls']
+        if not youtube_args['skip']:
+            del youtube_args['skip']
+
+class RateShare:
+    """A job's per-connection rate limit, stored as params['ratelimit'].
+    yt-dlp re-reads ratelimit on every block, but FragmentFD hands each fragment downloader a copy
+    of the params. The copy still points at this object, so rebalancing reaches those downloads too.
+    This leans on yt-dlp internals: keep yt-dlp pinned and tests/test_rate_limit.py passing on upgrades"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    # Just enough of a number for FileDownloader.slow_down: speed > limit and bytes / limit
+    def __lt__(self, other):
+        return self.value < other
+
+    def __gt__(self, other):
+        return self.value > other
+
+    def __rtruediv__(self, other):
+        return other / self.value
+
+    def __float__(self):
+        return float(self.value)
+
+    def __int__(self):
+        return int(self.value)
+
+    def __str__(self):
+        return str(int(self.value))
+
+def is_fragmented(fmt):
+    """DASH/HLS formats, which yt-dlp downloads over concurrent_fragment_downloads connections"""
+    return bool(fmt.get('fragments')) or (fmt.get('protocol') or '').startswith(('m3u8', 'http_dash_segments'))
+
+class DownloadTuner:
+    """Fast download profile: sizes buffers and HTTP chunks from recently measured
+    throughput and splits the global bandwidth budget across running jobs"""
+
+    def __init__(self, concurrency, max_chunk_size, budget):
+        self.concurrency = max(1, concurrency)
+        self.max_chunk_size = max_chunk_size
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.speed = None  # moving average of per-job speed, bytes/s
+        self.active = []  # (RateShare, connections) of running downloads
+
+    def hook(self, d):
+        """yt-dlp progress hook; folds the reported speed into the moving average"""
+        speed = d.get('speed')
+        if d.get('status') != 'downloading' or not speed:
+            return
+        with self.lock:
+            self.speed = speed if self.speed is None else 0.8 * self.speed + 0.2 * speed
+
+    def buffer_size(self):
+        """Read buffer for one connection: roughly 1/8 s of data at the measured speed"""
+        if not self.speed:
+            return 128 * 1024
+        per_connection = self.speed / self.concurrency / 8
+        size = MIN_BUFFER_SIZE
+        while size < per_connection and size < MAX_BUFFER_SIZE:
+            size *= 2
+        return size
+
+    def chunk_size(self):
+        """HTTP range size: about 5 s of data at the measured speed, within the configured maximum"""
+        if not self.speed:
+            return self.max_chunk_size
+        return int(min(self.max_chunk_size, max(MIN_CHUNK_SIZE, self.speed * 5)))
+
+    def tune(self, ydl_opts):
+        allow_hls(ydl_opts)
+        ydl_opts['concurrent_fragment_downloads'] = self.concurrency
+        ydl_opts['http_chunk_size'] = self.chunk_size()
+        ydl_opts['buffersize'] = self.buffer_size()
+        ydl_opts['progress_hooks'] = ydl_opts['progress_hooks'] + [self.hook]
+
+    @staticmethod
+    def connections(params, info):
+        """Connections one download keeps open: one per fragment thread for DASH/HLS, otherwise one"""
+        concurrency = params.get('concurrent_fragment_downloads') or 1
+        if concurrency == 1:
+            return 1
+        formats = {f.get('format_id'): f for f in (info or {}).get('formats') or []}
+        # The exact choice from select_format; anything else (fallbacks, re-extraction) is assumed fragmented
+        chosen = [formats.get(format_id) for format_id in params.get('format', '').split('/')[0].split('+')]
+        if None in chosen:
+            return concurrency
+        return concurrency if any(is_fragmented(f) for f in chosen) else 1
+
+    def _rebalance(self):
+        if not self.active:
+            return
+        # yt-dlp applies the rate limit per connection
+        share = self.budget // len(self.active)
+        for rate, connections in self.active:
+            rate.value = max(MIN_BUFFER_SIZE, share // connections)
+
+    @contextlib.contextmanager
+    def limit(self, params, info=None):
+        """Hold a share of the bandwidth budget for the lifetime of one download;
+        shares of running downloads are rebalanced whenever one starts or finishes"""
+        if not self.budget:
+            yield
+            return
+        entry = (RateShare(self.budget), self.connections(params, info))
+        params['ratelimit'] = entry[0]
+        with self.lock:
+            self.active.append(entry)
+            self._rebalance()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active.remove(entry)
+                self._rebalance()
+
+download_tuner = DownloadTuner(FRAGMENT_CONCURRENCY, HTTP_CHUNK_SIZE, BANDWIDTH_BUDGET)
+
+def get_enhanced_ydl_opts(output_file, format_spec, postprocessors, my_hook, player_client=None):
     """Get yt-dlp options with enhanced stability"""
     
-    # Download cookies if available
-    cookies_available = download_cookies()
-    
     # Base options with focus on stability
     ydl_opts = {
         'outtmpl': output_file,
@@ -433,172 +2023,1001 @@ def get_enhanced_ydl_opts(output_file, format_spec, postprocessors, my_hook):
         'no_warnings': False,
     }
     
+    # Stick with the client that worked during probing
+    if player_client:
+        ydl_opts['extractor_args']['youtube']['player_client'] = list(player_client)
+    
     # Add FFmpeg location if available
     if FFMPEG_AVAILABLE:
         ffmpeg_path = shutil.which('ffmpeg')
         if ffmpeg_path:
             ydl_opts['ffmpeg_location'] = os.path.dirname(ffmpeg_path)
     
-    # Add cookies if available
-    if cookies_available and os.path.exists('cookies.txt'):
-        ydl_opts['cookiefile'] = 'cookies.txt'
-    
     # Add proxy if available
     proxy = os.getenv('PROXY_URL')
     if proxy:
         ydl_opts['proxy'] = proxy
     
+    if DOWNLOAD_PROFILE == 'fast':
+        download_tuner.tune(ydl_opts)
+    
     return ydl_opts
 
-async def download_video(update: Update, context: CallbackContext):
+# Download scheduler settings
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))
+MAX_ACTIVE_PER_USER = int(os.getenv("MAX_ACTIVE_PER_USER", "1"))
+MAX_QUEUED_PER_USER = int(os.getenv("MAX_QUEUED_PER_USER", "3"))
+MAX_QUEUE_LENGTH = int(os.getenv("MAX_QUEUE_LENGTH", "50"))
+# Lifetime of shared per-user job counters, in case a worker dies mid-job
+ACTIVE_JOB_TTL = int(os.getenv("ACTIVE_JOB_TTL", "3600"))
+
+class _Ticket:
+    __slots__ = ('future', 'on_position', 'position', 'queued_at', 'max_active')
+
+    def __init__(self, future, on_position, max_active=None):
+        self.future = future
+        self.on_position = on_position
+        self.max_active = max_active  # per-user cap for this job, when it differs from the scheduler's
+        self.position = None
+        self.queued_at = time.monotonic()
+
+class DownloadScheduler:
+    """Fair round-robin download scheduler with global and per-user concurrency caps"""
+
+    def __init__(self, max_active, max_active_per_user, max_queued_per_user, max_queue, backend):
+        self.executor = ThreadPoolExecutor(max_workers=max_active, thread_name_prefix="download")
+        # With a shared backend the per-user cap counts jobs on every worker process
+        self.backend = backend if backend.shared else None
+        self.shared_active = {}  # user_id -> job count on all workers, as of the last poll
+        self.retry_handle = None
+        self.poll_task = None
+        self.max_active = max_active
+        self.max_active_per_user = max_active_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.max_queue = max_queue
+        self.waiting = OrderedDict()  # user_id -> deque of tickets, in round-robin order
+        self.active = {}  # user_id -> running job count
+        self.active_total = 0
+        self.stats = {'started': 0, 'rejected': 0, 'queue_wait_total': 0.0}
+
+    def queue_length(self):
+        return sum(len(tickets) for tickets in self.waiting.values())
+
+    async def run(self, user_id, func, *args, on_position=None, max_active=None):
+        """Wait for a slot, then run func(*args) on a download worker.
+        max_active overrides the per-user cap for this job (batches bring their own allowance)"""
+        await self.acquire(user_id, on_position, max_active)
+        loop = asyncio.get_running_loop()
+        try:
+            job = self.executor.submit(contextvars.copy_context().run, func, *args)
+        except BaseException:
+            self.release(user_id)
+            raise
+        # Cancelling the caller doesn't stop a running thread, so the slot is held until the job really ends
+        job.add_done_callback(lambda _: self._release_threadsafe(loop, user_id))
+        return await asyncio.wrap_future(job)
+
+    def _release_threadsafe(self, loop, user_id):
+        try:
+            loop.call_soon_threadsafe(self.release, user_id)
+        except RuntimeError:
+            pass  # Loop already closed at shutdown; nothing is left to schedule
+
+    async def acquire(self, user_id, on_position=None, max_active=None):
+        if self.backend:
+            await self._poll_shared((user_id,))
+        # Backpressure: refuse new work instead of letting the queue grow without bound
+        if self.queue_length() >= self.max_queue:
+            self.stats['rejected'] += 1
+            raise Exception("Download queue is full - the server is busy right now")
+        if len(self.waiting.get(user_id, ())) >= self.max_queued_per_user:
+            self.stats['rejected'] += 1
+            raise Exception(f"Your download queue is full ({self.max_queued_per_user} pending)")
+
+        ticket = _Ticket(asyncio.get_running_loop().create_future(), on_position, max_active)
+        self.waiting.setdefault(user_id, deque()).append(ticket)
+        self._dispatch()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self.release(user_id)
+            else:
+                self._remove(user_id, ticket)
+            raise
+        waited = time.monotonic() - ticket.queued_at
+        self.stats['queue_wait_total'] += waited
+        stage_seconds.observe(waited, 'queue_wait')
+        if waited > 0.1:
+            logger.info(f"⏱️ Download for {user_id} waited {waited:.1f}s in queue")
+
+    def release(self, user_id):
+        self.active_total -= 1
+        self.active[user_id] -= 1
+        if not self.active[user_id]:
+            del self.active[user_id]
+        if self.backend:
+            self._publish(user_id, -1)
+        self._dispatch()
+
+    def _user_active(self, user_id):
+        if self.backend:
+            return max(self.shared_active.get(user_id, 0), self.active.get(user_id, 0))
+        return self.active.get(user_id, 0)
+
+    def _publish(self, user_id, delta):
+        # Keep the cached count in step with our own jobs until the next poll replaces it
+        count = max(self.shared_active.get(user_id, 0) + delta, 0)
+        if count or user_id in self.waiting:
+            self.shared_active[user_id] = count
+        else:
+            self.shared_active.pop(user_id, None)
+        write_behind(self.backend.aincr("active_jobs", str(user_id), delta, time.time() + ACTIVE_JOB_TTL),
+                     f"active_jobs {user_id}")
+
+    async def _poll_shared(self, user_ids):
+        """Refresh the cached shared job counts, which include this worker's own jobs"""
+        for user_id in user_ids:
+            try:
+                stored = await self.backend.aget("active_jobs", str(user_id))
+            except Exception as e:
+                logger.warning(f"Failed to read shared job count for {user_id}: {e}")
+                continue
+            self.shared_active[user_id] = stored[0] if stored else 0
+
+    def _retry_dispatch(self):
+        self.retry_handle = None
+        self.poll_task = asyncio.get_running_loop().create_task(self._poll_and_dispatch())
+
+    async def _poll_and_dispatch(self):
+        try:
+            await self._poll_shared(list(self.waiting))
+        finally:
+            self.poll_task = None
+        for user_id in [user_id for user_id in self.shared_active
+                        if user_id not in self.waiting and user_id not in self.active]:
+            del self.shared_active[user_id]
+        self._dispatch()
+
+    def _remove(self, user_id, ticket):
+        tickets = self.waiting.get(user_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self.waiting[user_id]
+                if user_id not in self.active:
+                    self.shared_active.pop(user_id, None)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to waiting users, one job per user per round"""
+        while self.active_total < self.max_active:
+            for user_id, tickets in self.waiting.items():
+                if self._user_active(user_id) < (tickets[0].max_active or self.max_active_per_user):
+                    break
+            else:
+                break
+            ticket = tickets.popleft()
+            if tickets:
+                self.waiting.move_to_end(user_id)
+            else:
+                del self.waiting[user_id]
+            if ticket.future.done():
+                continue  # Cancelled while queued; its task has already given up
+            ticket.future.set_result(True)
+            self.active[user_id] = self.active.get(user_id, 0) + 1
+            self.active_total += 1
+            if self.backend:
+                self._publish(user_id, 1)
+            self.stats['started'] += 1
+        # Slots freed by other workers aren't announced, so poll while jobs are held back
+        if (self.backend and self.waiting and self.active_total < self.max_active
+                and self.retry_handle is None and self.poll_task is None):
+            self.retry_handle = asyncio.get_running_loop().call_later(1.0, self._retry_dispatch)
+        self._notify_positions()
+
+    def _notify_positions(self):
+        # Service order interleaves users: everyone's first job, then everyone's second, ...
+        rounds = {}
+        for tickets in self.waiting.values():
+            for depth, ticket in enumerate(tickets):
+                rounds.setdefault(depth, []).append(ticket)
+        position = 0
+        for depth in sorted(rounds):
+            for ticket in rounds[depth]:
+                position += 1
+                if ticket.on_position and ticket.position != position:
+                    ticket.position = position
+                    ticket.on_position(position)
+
+download_scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_ACTIVE_PER_USER,
+                                       MAX_QUEUED_PER_USER, MAX_QUEUE_LENGTH, state_backend)
+
+# Transcode pool settings (each worker drives one FFmpeg process)
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(os.cpu_count() or 2)))
+TRANSCODE_QUEUE_SIZE = int(os.getenv("TRANSCODE_QUEUE_SIZE", "50"))
+TRANSCODE_TIMEOUT = float(os.getenv("TRANSCODE_TIMEOUT", "600"))
+
+transcode_pool = WorkerPool("transcode", TRANSCODE_WORKERS, TRANSCODE_QUEUE_SIZE, TRANSCODE_TIMEOUT)
+
+# Audio outputs; sources whose codec is in copy_codecs are remuxed without re-encoding
+AUDIO_TARGETS = {
+    'mp3': {'ext': 'mp3', 'muxer': 'mp3', 'codec': 'libmp3lame', 'bitrate': '192k', 'copy_codecs': ('mp3',)},
+    'm4a': {'ext': 'm4a', 'muxer': 'ipod', 'codec': 'aac', 'bitrate': '192k', 'copy_codecs': ('mp4a', 'aac')},
+}
+
+def transcode_audio(source_path, target, source_codec=None):
+    """Convert a downloaded file to the target audio format with FFmpeg (called on a transcode worker)"""
+    spec = AUDIO_TARGETS[target]
+    base, ext = os.path.splitext(source_path)
+    copy_ok = bool(source_codec) and source_codec.lower().startswith(spec['copy_codecs'])
+    if copy_ok and ext.lstrip('.') == spec['ext']:
+        return source_path
+    output_path = f"{base}.{spec['ext']}"
+    if output_path == source_path:
+        output_path = f"{base}.converted.{spec['ext']}"
+    
+    commands = []
+    if copy_ok:
+        # Fast path: the stream is already in the right codec, only the container changes
+        commands.append(['-c:a', 'copy'])
+    commands.append(['-c:a', spec['codec'], '-b:a', spec['bitrate']])
+    
+    for codec_args in commands:
+        result = subprocess.run(
+            ['ffmpeg', '-y', '-v', 'error', '-i', source_path, '-vn', *codec_args, output_path],
+            capture_output=True, timeout=TRANSCODE_TIMEOUT
+        )
+        if result.returncode == 0:
+            break
+        logger.warning(f"FFmpeg {' '.join(codec_args)} failed: {result.stderr.decode(errors='ignore')[-200:]}")
+    else:
+        raise Exception("FFmpeg audio conversion failed")
+    
+    logger.info(f"🎛️ {'Remuxed' if codec_args[1] == 'copy' else 'Encoded'} {os.path.basename(source_path)} -> {spec['ext']}")
+    os.remove(source_path)
+    return output_path
+
+# Bot API endpoint settings. A self-hosted telegram-bot-api server (after a one-time logOut
+# from the cloud API) lifts the upload cap to 2000MB and, in local mode, reads files from disk.
+BOT_API_URL = os.getenv("BOT_API_URL")  # e.g. "http://telegram-bot-api:8081/bot"
+BOT_API_FILE_URL = os.getenv("BOT_API_FILE_URL")  # e.g. "http://telegram-bot-api:8081/file/bot"
+BOT_API_LOCAL_MODE = os.getenv("BOT_API_LOCAL_MODE", "").lower() in ("1", "true", "yes")
+# Worst-case upload speed used to scale the upload timeout with file size
+MIN_UPLOAD_SPEED = float(os.getenv("MIN_UPLOAD_SPEED_KBPS", "256")) * 1024
+
+# Upload size settings
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_MB", "2000" if BOT_API_LOCAL_MODE else "50")) * 1024 * 1024
+OVERSIZE_MODE = os.getenv("OVERSIZE_MODE", "auto")  # auto | split | reencode | off
+
+# Encoders used when re-encoding audio to fit, by container extension
+AUDIO_ENCODERS = {'.mp3': 'libmp3lame', '.m4a': 'aac', '.aac': 'aac', '.opus': 'libopus', '.ogg': 'libvorbis'}
+
+def estimate_format_size(fmt, duration=None):
+    """Best guess at a format's size in bytes from filesize, filesize_approx or tbr x duration"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return size
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+def probe_duration(path):
+    """Media duration in seconds via ffprobe, or None"""
+    if not FFPROBE_AVAILABLE:
+        return None
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=nw=1:nk=1', path],
+        capture_output=True, timeout=30
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+def run_ffmpeg(args, error_message):
+    result = subprocess.run(['ffmpeg', '-y', '-v', 'error', *args], capture_output=True, timeout=TRANSCODE_TIMEOUT)
+    if result.returncode != 0:
+        logger.warning(f"FFmpeg failed: {result.stderr.decode(errors='ignore')[-200:]}")
+        raise Exception(error_message)
+
+def split_by_size(path, duration, limit):
+    """Stream-copy a file into sequential parts that each fit under limit"""
+    base, ext = os.path.splitext(path)
+    directory, prefix = os.path.split(f"{base}.part")
+    segment_time = duration * limit * 0.9 / os.path.getsize(path)
+    for attempt in range(3):
+        parts = []
+        for name in os.listdir(directory or '.'):
+            if name.startswith(prefix):
+                os.remove(os.path.join(directory, name))
+        run_ffmpeg(['-i', path, '-map', '0', '-c', 'copy', '-f', 'segment', '-segment_time', f"{segment_time:.2f}",
+                    '-reset_timestamps', '1', f"{base}.part%03d{ext}"], "FFmpeg could not split the file")
+        parts = sorted(os.path.join(directory, name) for name in os.listdir(directory or '.') if name.startswith(prefix))
+        # Cuts land on keyframes, so a part can overshoot; retry with shorter segments
+        if parts and all(os.path.getsize(part) <= limit for part in parts):
+            logger.info(f"✂️ Split {os.path.basename(path)} into {len(parts)} parts")
+            os.remove(path)
+            return parts
+        segment_time *= 0.7
+    raise Exception("FFmpeg could not split the file into small enough parts")
+
+def reencode_to_size(path, media_kind, duration, limit):
+    """Re-encode at the bitrate that makes the output fit under limit, or None if that would be unwatchable"""
+    base, ext = os.path.splitext(path)
+    total_kbps = int(limit * 8 * 0.93 / duration / 1000)
+    if media_kind == 'audio':
+        if total_kbps < 32:
+            return None
+        encoder = AUDIO_ENCODERS.get(ext, 'aac')
+        output_path = f"{base}.fit{ext if ext in AUDIO_ENCODERS else '.m4a'}"
+        args = ['-i', path, '-vn', '-c:a', encoder, '-b:a', f"{min(total_kbps, 320)}k", output_path]
+    else:
+        audio_kbps = 96 if total_kbps < 1000 else 128
+        video_kbps = total_kbps - audio_kbps
+        if video_kbps < 150:
+            return None
+        output_path = f"{base}.fit.mp4"
+        args = ['-i', path, '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', f"{video_kbps}k",
+                '-maxrate', f"{video_kbps}k", '-bufsize', f"{video_kbps * 2}k",
+                '-c:a', 'aac', '-b:a', f"{audio_kbps}k", '-movflags', '+faststart', output_path]
+    run_ffmpeg(args, "FFmpeg could not re-encode the file to fit the upload limit")
+    if os.path.getsize(output_path) > limit:
+        os.remove(output_path)
+        return None
+    logger.info(f"🗜️ Re-encoded {os.path.basename(path)} at {total_kbps}kbps to fit the upload limit")
+    os.remove(path)
+    return output_path
+
+def fit_to_upload_limit(path, media_kind, duration, limit):
+    """Make an oversized output deliverable by re-encoding or splitting it (called on a transcode worker).
+    Returns the list of files to upload."""
+    duration = duration or probe_duration(path)
+    if not duration:
+        raise Exception("File too large and its duration is unknown, so it can't be split")
+    mode = OVERSIZE_MODE
+    if mode == 'auto':
+        mode = 'reencode' if media_kind == 'audio' else 'split'
+    if mode == 'reencode':
+        output_path = reencode_to_size(path, media_kind, duration, limit)
+        if output_path:
+            return [output_path]
+    return split_by_size(path, duration, limit)
+
+_upload_client = None
+
+def get_upload_timeout(size):
+    return 60 + size / MIN_UPLOAD_SPEED
+
+def get_upload_client():
+    global _upload_client
+    if _upload_client is None:
+        _upload_client = httpx.AsyncClient(timeout=httpx.Timeout(60, connect=15, pool=15))
+    return _upload_client
+
+@contextlib.contextmanager
+def upload_link(path, filename):
+    """Expose a file under its display name; in local mode the server names documents after the file on disk"""
+    link_dir = f"{path}.upload"
+    os.makedirs(link_dir, exist_ok=True)
+    link_path = os.path.join(link_dir, filename)
+    try:
+        os.link(path, link_path)
+    except OSError:
+        shutil.copyfile(path, link_path)
+    try:
+        yield pathlib.Path(link_path).absolute()
+    finally:
+        shutil.rmtree(link_dir, ignore_errors=True)
+
+def bot_api_result(response):
+    """The result of a raw Bot API call, raising the same errors PTB would"""
+    payload = response.json()
+    if not payload.get('ok'):
+        description = payload.get('description', f"HTTP {response.status_code}")
+        retry_after = (payload.get('parameters') or {}).get('retry_after')
+        if retry_after:
+            record_retry_after(retry_after)
+            raise RetryAfter(retry_after)
+        if response.status_code == 400:
+            raise BadRequest(description)
+        raise TelegramError(description)
+    return payload['result']
+
+async def upload_document(context: CallbackContext, chat_id, path, filename):
+    """Send a file (a path, or a MemoryFile from the streaming pipeline) as a document without copying it.
+    In local mode the Bot API server reads it from disk; otherwise it is streamed as multipart."""
+    timeout = get_upload_timeout(media_size(path))
+    
+    if BOT_API_LOCAL_MODE and not isinstance(path, MemoryFile):
+        with upload_link(path, filename) as link_path:
+            return await context.bot.send_document(
+                chat_id=chat_id,
+                document=link_path,
+                write_timeout=timeout,
+                read_timeout=timeout
+            )
+    
+    # PTB's InputFile reads whole files into memory; httpx streams file objects in chunks
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    with open_media(path) as f:
+        response = await get_upload_client().post(
+            f"{context.bot.base_url}/sendDocument",
+            data={'chat_id': str(chat_id)},
+            files={'document': (filename, f, content_type)},
+            timeout=httpx.Timeout(timeout, connect=15, pool=15)
+        )
+    return Message.de_json(bot_api_result(response), context.bot)
+
+async def upload_media_group(context: CallbackContext, chat_id, documents):
+    """Send 2-10 documents as one album, streamed like upload_document.
+    Each document is (filename, path, file_id) with either a path (or MemoryFile) or a cached file_id set."""
+    timeout = get_upload_timeout(sum(media_size(path) for _, path, _ in documents if path))
+    
+    with contextlib.ExitStack() as stack:
+        if BOT_API_LOCAL_MODE:
+            media = [InputMediaDocument(file_id or stack.enter_context(upload_link(path, filename)))
+                     for filename, path, file_id in documents]
+            return list(await context.bot.send_media_group(
+                chat_id=chat_id, media=media, write_timeout=timeout, read_timeout=timeout))
+        
+        media, files = [], {}
+        for index, (filename, path, file_id) in enumerate(documents):
+            if file_id:
+                media.append({'type': 'document', 'media': file_id})
+                continue
+            content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            files[f"file{index}"] = (filename, stack.enter_context(open_media(path)), content_type)
+            media.append({'type': 'document', 'media': f"attach://file{index}"})
+        response = await get_upload_client().post(
+            f"{context.bot.base_url}/sendMediaGroup",
+            data={'chat_id': str(chat_id), 'media': json.dumps(media)},
+            files=files or None,
+            timeout=httpx.Timeout(timeout, connect=15, pool=15)
+        )
+    return Message.de_list(bot_api_result(response), context.bot)
+
+# Streaming audio settings: download straight into FFmpeg and keep the result in memory
+STREAM_AUDIO = os.getenv("STREAM_AUDIO", "false").lower() in ('1', 'true', 'yes')
+# Largest source stream handled in memory; bigger jobs use the disk pipeline
+STREAM_MAX_SIZE = int(float(os.getenv("STREAM_MAX_MB", "64")) * 1024 * 1024)
+
+class StreamFallback(Exception):
+    """The streaming pipeline gave up; the job should go through the disk pipeline instead"""
+
+class MemoryFile:
+    """Finished media held in a memfd (or a BytesIO where memfd is unavailable) instead of on disk"""
+
+    __slots__ = ('buffer', 'size', 'ext')
+
+    def __init__(self, buffer, size, ext):
+        self.buffer = buffer
+        self.size = size
+        self.ext = ext
+
+    def reopen(self):
+        """Independent read handle positioned at the start"""
+        if isinstance(self.buffer, io.BytesIO):
+            return io.BytesIO(self.buffer.getbuffer())
+        return open(f"/proc/self/fd/{self.buffer.fileno()}", 'rb')
+
+    def close(self):
+        self.buffer.close()
+
+def media_size(path):
+    """Size of an output file, given as a path or a MemoryFile"""
+    return path.size if isinstance(path, MemoryFile) else os.path.getsize(path)
+
+def open_media(path):
+    return path.reopen() if isinstance(path, MemoryFile) else open(path, 'rb')
+
+def get_stream_source(format_type, format_spec, info, audio_formats):
+    """The probed audio format to stream for this job, or None when the disk pipeline must be used"""
+    if format_type not in AUDIO_TARGETS or not FFMPEG_AVAILABLE or BOT_API_LOCAL_MODE:
+        return None
+    if not is_info_fresh(info):
+        return None
+    format_id = format_spec.split('/')[0]
+    fmt = next((f for f in audio_formats if f.get('format_id') == format_id), None)
+    # Single-file HTTP sources only; fragmented (DASH/HLS) streams need yt-dlp's downloaders
+    if fmt is None or fmt.get('protocol', 'https') not in ('http', 'https') or not fmt.get('url'):
+        return None
+    size = estimate_format_size(fmt, info.get('duration'))
+    if not size or size > min(STREAM_MAX_SIZE, MAX_UPLOAD_SIZE):
+        return None
+    return fmt
+
+def stream_audio(fmt, target, progress_hook):
+    """Download fmt in ranged chunks straight into FFmpeg's stdin and collect its output in memory.
+    Returns a MemoryFile; raises StreamFallback on any failure (called on a download worker)"""
+    spec = AUDIO_TARGETS[target]
+    copy_ok = (fmt.get('acodec') or '').lower().startswith(spec['copy_codecs'])
+    codec_args = ['-c:a', 'copy'] if copy_ok else ['-c:a', spec['codec'], '-b:a', spec['bitrate']]
+
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create(f"media.{spec['ext']}")
+        buffer = os.fdopen(fd, 'w+b')
+        # Seekable output, so regular (non-fragmented) containers work
+        output_args, pass_fds = ['-f', spec['muxer'], f"/dev/fd/{fd}"], (fd,)
+    else:
+        buffer = io.BytesIO()
+        output_args, pass_fds = ['-f', spec['muxer'], '-movflags', 'frag_keyframe+empty_moov', 'pipe:1'], ()
+
+    # -xerror: a source that can't be read from a pipe (MP4 with its index at the end)
+    # must fail loudly so the job falls back to disk instead of producing an empty file
+    process = subprocess.Popen(
+        ['ffmpeg', '-y', '-v', 'error', '-xerror', '-i', 'pipe:0', '-vn', *codec_args, *output_args],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=pass_fds
+    )
+    # Drain FFmpeg's output pipes on helper threads so writing to stdin can never deadlock
+    stderr_chunks = []
+    drains = [threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)]
+    if pass_fds:
+        drains.append(threading.Thread(target=process.stdout.read, daemon=True))
+    else:
+        drains.append(threading.Thread(target=lambda: shutil.copyfileobj(process.stdout, buffer), daemon=True))
+    for thread in drains:
+        thread.start()
+
+    try:
+        # Only an exact size will do: stopping at a low filesize_approx would upload a truncated file
+        total = fmt.get('filesize')
+        downloaded = 0
+        started = time.monotonic()
+        proxy = os.getenv('PROXY_URL')
+        with httpx.Client(headers=fmt.get('http_headers'), proxies=proxy, follow_redirects=True,
+                          timeout=httpx.Timeout(45, connect=15)) as client:
+            # Ranged requests like yt-dlp's http_chunk_size; YouTube throttles long single responses
+            while total is None or downloaded < total:
+                start, end = downloaded, downloaded + HTTP_CHUNK_SIZE - 1
+                with client.stream('GET', fmt['url'], headers={'Range': f"bytes={start}-{end}"}) as response:
+                    if response.status_code == 416 and total is None and downloaded:
+                        break  # unknown length that was an exact multiple of the chunk size
+                    if response.status_code not in (200, 206):
+                        raise StreamFallback(f"HTTP {response.status_code}")
+                    # The server's own length wins over anything yt-dlp reported
+                    length = response.headers.get('Content-Range', '').rpartition('/')[2]
+                    if length.isdigit():
+                        total = int(length)
+                    for chunk in response.iter_bytes(256 * 1024):
+                        downloaded += len(chunk)
+                        if downloaded > STREAM_MAX_SIZE:
+                            raise StreamFallback("source larger than the streaming limit")
+                        process.stdin.write(chunk)
+                        elapsed = time.monotonic() - started
+                        progress_hook({'status': 'downloading', 'downloaded_bytes': downloaded, 'total_bytes': total,
+                                       'speed': downloaded / elapsed if elapsed else None})
+                    if response.status_code == 200:
+                        break  # the server ignored the range and sent everything
+                    if total is None and downloaded - start < HTTP_CHUNK_SIZE:
+                        break  # unknown length: a short range was the last one
+        if total is not None and downloaded != total:
+            raise StreamFallback(f"got {downloaded} of {total} bytes")
+        process.stdin.close()
+        progress_hook({'status': 'finished'})
+        process.wait(timeout=TRANSCODE_TIMEOUT)
+        for thread in drains:
+            thread.join()
+        if process.returncode != 0:
+            stderr = b''.join(stderr_chunks).decode(errors='ignore')
+            raise StreamFallback(f"FFmpeg {' '.join(codec_args)} failed: {stderr[-200:]}")
+        size = buffer.seek(0, os.SEEK_END)
+        if size > MAX_UPLOAD_SIZE:
+            raise StreamFallback("output larger than the upload limit")
+        buffer.seek(0)
+        logger.info(f"🌊 Streamed {downloaded / (1024 * 1024):.1f}MB into "
+                    f"{size / (1024 * 1024):.1f}MB of {spec['ext']} without touching disk")
+        return MemoryFile(buffer, size, f".{spec['ext']}")
+    except Exception as e:
+        process.kill()
+        process.wait()
+        for thread in drains:
+            thread.join(timeout=5)
+        buffer.close()
+        if isinstance(e, StreamFallback):
+            raise
+        raise StreamFallback(str(e)) from e
+    finally:
+        for pipe in (process.stdin, process.stdout, process.stderr):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+# Scratch space settings
+DOWNLOADS_DIR = os.getenv("DOWNLOADS_DIR", "downloads")
+DOWNLOADS_QUOTA = int(os.getenv("DOWNLOADS_QUOTA_MB", "4096")) * 1024 * 1024
+# Entries not owned by a running job (crashed jobs, other leftovers) are removed after this long
+ORPHAN_MAX_AGE = int(os.getenv("ORPHAN_MAX_AGE", "3600"))
+# Partial files inside a running job that haven't been written to for this long are dropped
+PARTIAL_MAX_AGE = int(os.getenv("PARTIAL_MAX_AGE", "1800"))
+JANITOR_INTERVAL = int(os.getenv("JANITOR_INTERVAL", "300"))
+PARTIAL_SUFFIXES = ('.part', '.ytdl', '.temp', '.tmp')
+
+def is_partial_file(name):
+    return name.endswith(PARTIAL_SUFFIXES) or '.part-Frag' in name
+
+class Janitor:
+    """Hands out per-job scratch directories and keeps the downloads directory small"""
+
+    def __init__(self, root, quota, orphan_max_age, partial_max_age, interval):
+        self.root = root
+        self.quota = quota
+        self.orphan_max_age = orphan_max_age
+        self.partial_max_age = partial_max_age
+        self.interval = interval
+        self.active = set()  # job directories owned by running jobs
+        self.usage = 0  # bytes in use as of the last sweep
+
+    def create_job_dir(self, prefix):
+        os.makedirs(self.root, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=f"{prefix}_", dir=self.root)
+        self.active.add(path)
+        return path
+
+    def release_job_dir(self, path):
+        self.active.discard(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def _measure(path):
+        """Total size and newest modification time of a file or directory tree"""
+        if not os.path.isdir(path):
+            st = os.stat(path)
+            return st.st_size, st.st_mtime
+        size, newest = 0, os.stat(path).st_mtime
+        for directory, _, files in os.walk(path):
+            for name in files:
+                try:
+                    st = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                size += st.st_size
+                newest = max(newest, st.st_mtime)
+        return size, newest
+
+    def _remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def sweep(self):
+        """One cleanup pass (blocking, run off the event loop); returns bytes still in use"""
+        if not os.path.isdir(self.root):
+            self.usage = 0
+            return 0
+        now = time.time()
+        active = set(self.active)
+        usage, removed, evictable = 0, 0, []
+        for entry in os.scandir(self.root):
+            try:
+                size, mtime = self._measure(entry.path)
+            except OSError:
+                continue
+            if entry.path in active:
+                for directory, _, files in os.walk(entry.path):
+                    for name in files:
+                        path = os.path.join(directory, name)
+                        try:
+                            if is_partial_file(name) and now - os.path.getmtime(path) > self.partial_max_age:
+                                size -= os.path.getsize(path)
+                                os.remove(path)
+                                removed += 1
+                        except OSError:
+                            pass
+                usage += size
+            elif now - mtime > self.orphan_max_age:
+                self._remove(entry.path)
+                removed += 1
+            else:
+                usage += size
+                evictable.append((mtime, entry.path, size))
+        # Over quota: evict leftovers oldest first; running jobs are never touched
+        for mtime, path, size in sorted(evictable):
+            if usage <= self.quota:
+                break
+            self._remove(path)
+            usage -= size
+            removed += 1
+        if removed:
+            logger.info(f"🧹 Janitor removed {removed} stale entries, {usage / (1024 * 1024):.1f}MB in use")
+        if usage > self.quota:
+            logger.warning(f"⚠️ Downloads directory over quota: {usage / (1024 * 1024):.1f}MB in use")
+        self.usage = usage
+        return usage
+
+    async def run(self):
+        """Background cleanup loop"""
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f"Janitor error: {e}")
+            await asyncio.sleep(self.interval)
+
+janitor = Janitor(DOWNLOADS_DIR, DOWNLOADS_QUOTA, ORPHAN_MAX_AGE, PARTIAL_MAX_AGE, JANITOR_INTERVAL)
+
+def get_downloaded_path(info, job_dir):
+    """Final output file of a download, as reported by yt-dlp"""
+    for download in (info or {}).get('requested_downloads') or []:
+        path = download.get('filepath')
+        if path and os.path.exists(path):
+            return path
+    # Fallback for downloads that don't report requested_downloads
+    files = [os.path.join(job_dir, f) for f in os.listdir(job_dir) if not is_partial_file(f)]
+    return max(files, key=os.path.getsize) if files else None
+
+async def create_job_dir(prefix):
+    """Scratch directory for one job; refuses new work while the downloads directory is over quota"""
+    if janitor.usage > DOWNLOADS_QUOTA:
+        await asyncio.to_thread(janitor.sweep)
+        if janitor.usage > DOWNLOADS_QUOTA:
+            raise Exception("Download queue is full - server storage is busy right now")
+    return janitor.create_job_dir(prefix)
+
+def clean_title(title, fallback):
+    """Title made safe for filenames and status messages"""
+    title = (title or fallback).replace('/', '_').replace('\\', '_')
+    return ''.join(c for c in title if c.isalnum() or c in (' ', '-', '_', '.')).strip()[:50]
+
+class JobError(Exception):
+    """A job ended without a file to send; error_class is its jobs_total label"""
+
+    def __init__(self, error_class, message):
+        super().__init__(message)
+        self.error_class = error_class
+
+class MediaJob:
+    """Turns one link into upload-ready files: probe, pick a format, download, convert and fit
+    under the upload limit. Single downloads and batch items both run through it"""
+
+    def __init__(self, url, format_type, quality, user_id, scratch_prefix, max_active=None):
+        self.url = url
+        self.format_type = format_type
+        self.quality = quality
+        self.user_id = user_id
+        self.scratch_prefix = scratch_prefix
+        self.max_active = max_active  # per-user download slots; None keeps the scheduler's default
+        self.info = None
+        self.title = None
+        self.strategy = None
+        self.size = 0  # output size before any fitting
+        self.paths = []  # files to upload: paths, or a single MemoryFile
+        self.job_dir = None
+        self.memory_file = None
+
+    async def run(self, progress_hook, on_stage=None, on_position=None, fallback_title=''):
+        """Fill self.paths; raises JobError when there is nothing to send.
+        on_stage(stage) is awaited on entering 'probing', 'downloading', 'converting' and 'fitting'"""
+        async def enter(stage):
+            if on_stage:
+                await on_stage(stage)
+
+        await enter('probing')
+        probe_started = time.monotonic()
+        info, video_formats, audio_formats, self.strategy = await metadata_cache.get_or_probe(self.url, get_available_formats)
+        stage_seconds.observe(time.monotonic() - probe_started, 'probe')
+        if not video_formats and not audio_formats:
+            raise JobError('no_content', "No downloadable content found")
+        self.info = info
+        self.title = clean_title(info.get('title'), '') or fallback_title
+        
+        # Pick one exact format, preferring ones that fit under the upload limit before spending any bandwidth
+        format_spec = select_format(self.format_type, self.quality, video_formats, audio_formats,
+                                    info.get('duration'), MAX_UPLOAD_SIZE)
+        await enter('downloading')
+        
+        # Audio that fits in memory can skip the disk entirely: download -> FFmpeg -> upload
+        file_path = None
+        stream_source = get_stream_source(self.format_type, format_spec, info, audio_formats) if STREAM_AUDIO else None
+        if stream_source:
+            try:
+                file_path = self.memory_file = await download_scheduler.run(
+                    self.user_id, timed_stage, 'stream', stream_audio, stream_source, self.format_type, progress_hook,
+                    on_position=on_position, max_active=self.max_active)
+            except StreamFallback as e:
+                logger.info(f"🌊 Streaming failed, falling back to disk: {e}")
+        
+        if file_path is None:
+            # Each job gets its own scratch directory, so outputs never collide or need searching for
+            self.job_dir = await create_job_dir(self.scratch_prefix)
+            # Audio conversion runs afterwards on the transcode pool, not in the download slot
+            ydl_opts = get_enhanced_ydl_opts(os.path.join(self.job_dir, "media.%(ext)s"), format_spec, [], progress_hook,
+                                             player_client=get_strategy_player_client(self.strategy))
+            
+            # Add random delay before download
+            await asyncio.sleep(random.uniform(1, 2))
+            
+            downloaded_info = await download_scheduler.run(self.user_id, timed_stage, 'download',
+                                                           download_with_ytdlp, ydl_opts, self.url, info,
+                                                           on_position=on_position, max_active=self.max_active)
+            file_path = get_downloaded_path(downloaded_info, self.job_dir)
+            if not file_path:
+                raise JobError('no_output', "No output file generated")
+            if self.format_type in AUDIO_TARGETS and FFMPEG_AVAILABLE:
+                await enter('converting')
+                file_path = await transcode_pool.run(timed_stage, 'transcode', transcode_audio, file_path, self.format_type,
+                                                     (downloaded_info or {}).get('acodec'), label=f"Transcode {self.format_type}")
+        
+        self.paths = [file_path]
+        self.size = media_size(file_path)
+        if self.size > MAX_UPLOAD_SIZE:
+            if OVERSIZE_MODE == 'off' or not FFMPEG_AVAILABLE:
+                raise JobError('too_large', f"File too large ({self.size / (1024 * 1024):.1f}MB)")
+            await enter('fitting')
+            media_kind = 'video' if self.format_type == 'mp4' else 'audio'
+            self.paths = await transcode_pool.run(timed_stage, 'fit', fit_to_upload_limit, file_path, media_kind,
+                                                  info.get('duration'), MAX_UPLOAD_SIZE, label="Fit to upload limit")
+
+    def documents(self):
+        """(filename, path) for each file to upload, numbered when the output was split"""
+        documents = []
+        for index, path in enumerate(self.paths, 1):
+            file_ext = path.ext if isinstance(path, MemoryFile) else os.path.splitext(path)[1]
+            if len(self.paths) == 1:
+                filename = f"{self.title}{file_ext}"
+            else:
+                filename = f"{self.title} (part {index} of {len(self.paths)}){file_ext}"
+            documents.append((filename, path))
+        return documents
+
+    def close(self):
+        """Remove the download and any converted or split outputs"""
+        if self.job_dir:
+            janitor.release_job_dir(self.job_dir)
+            self.job_dir = None
+        if self.memory_file:
+            self.memory_file.close()
+            self.memory_file = None
+
+async def choose_download(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
-    user_id = query.message.chat_id
-    quality = query.data
-    format_type = user_formats.get(user_id)
-    url = user_links.get(user_id)
-    
-    # Handle special cases
-    if quality == 'audio_original':
-        format_type = 'audio'
-        quality = 'best'
-    elif quality == 'cancel':
-        await query.edit_message_text("❌ Download cancelled.")
-        return
+    quality, token = parse_callback(query.data)
+    session = await sessions.get(token)
     
-    if not url or not format_type:
+    if not session or not session.format_type:
         await query.edit_message_text("❌ Missing information. Please start over.")
         return
+    
+    await download_video(query, context, session, quality)
 
+async def download_video(query, context: CallbackContext, session, quality):
+    user_id = session.chat_id
+    format_type = session.format_type
+    url = session.url
+    trace_id_var.set(secrets.token_hex(4))
+    logger.info(f"Job for {user_id}: {format_type} {quality} {url}")
+    
     message = await query.edit_message_text(f"🔍 **Checking video availability...**")
     message_id = message.message_id
-    user_messages[user_id] = message_id
-    last_update_time[user_id] = 0
-    last_percent[user_id] = 0
-
-    output_dir = "downloads"
-    os.makedirs(output_dir, exist_ok=True)
-    
-    timestamp = int(time.time())
-    output_file = os.path.join(output_dir, f"{user_id}_{timestamp}.%(ext)s")
 
     main_loop = asyncio.get_running_loop()
-    def my_hook(d):
-        main_loop.call_soon_threadsafe(main_loop.create_task, progress_hook(d, context, user_id, message_id))
+    progress = ProgressTracker(context, user_id, message_id)
+    job = MediaJob(url, format_type, quality, session.user_id, f"{user_id}_{session.token}")
+
+    download_type = format_type.upper() if format_type != 'audio' else 'AUDIO'
+    quality_label = quality if format_type == 'mp4' else 'Best Available'
+    cache_key = result_cache.make_key(url, format_type, quality)
+
+    async def show_stage(stage):
+        await progress.stop()
+        if stage == 'probing':
+            await safe_edit_message(context, user_id, message_id, "🔍 **Analyzing video formats...**")
+        elif stage == 'downloading':
+            await safe_edit_message(context, user_id, message_id,
+                f"⏬ **Starting download...**\n\n📹 **Title:** {job.title}\n🎯 **Format:** {download_type}\n📺 **Quality:** {quality_label}\n🔧 **Method:** {job.strategy}")
+            progress.start()
+        elif stage == 'converting':
+            await safe_edit_message(context, user_id, message_id, "🎛️ **Converting audio...**")
+        elif stage == 'fitting':
+            await safe_edit_message(context, user_id, message_id,
+                f"📦 **File is {job.size/(1024*1024):.1f}MB** - fitting it under the {MAX_UPLOAD_SIZE/(1024*1024):.0f}MB limit...")
+
+    def show_queue_position(position):
+        main_loop.create_task(safe_edit_message(context, user_id, message_id,
+            f"⏳ **You are #{position} in queue**\n\n📹 **Title:** {job.title}\n🎯 **Format:** {download_type}"))
 
     try:
-        # Get available formats first with better error handling
-        await safe_edit_message(context, user_id, message_id, "🔍 **Analyzing video formats...**")
-        info, video_formats, audio_formats, successful_strategy = await get_available_formats(url)
-        
-        # Check if we have usable formats
-        if not video_formats and not audio_formats:
-            await safe_edit_message(context, user_id, message_id, 
-                "❌ **No downloadable content found**\n\n"
-                "This video may be:\n"
-                "• A live stream or premiere\n"
-                "• Region/age restricted\n"
-                "• Private or deleted\n"
-                "• Contains only images\n\n"
-                "Please try a different video.")
+        # Identical request already uploaded once? Re-send it without downloading
+        if await send_cached_result(context, user_id, message_id, cache_key, download_type, quality_label):
+            jobs_total.inc('cached')
             return
         
-        # Get video title
-        video_title = info.get('title', f'video_{user_id}').replace('/', '_').replace('\\', '_')
-        video_title = ''.join(c for c in video_title if c.isalnum() or c in (' ', '-', '_', '.')).strip()[:50]
+        # Network down: keep the job queued until it's back rather than failing it
+        if not health.online:
+            await safe_edit_message(context, user_id, message_id,
+                "📡 **Network is unavailable**\n\nYour download is queued and will start once the connection is back.")
+            if not await health.wait_online(HEALTH_OFFLINE_WAIT):
+                raise Exception("Network connectivity issues detected")
         
-        # Generate optimal format string
-        format_spec = get_smart_format_string(format_type, quality, video_formats, audio_formats)
+        await job.run(progress.hook, show_stage, show_queue_position, fallback_title=f'video_{user_id}')
+        await progress.stop()
         
-        # Set postprocessors
-        if format_type == 'mp3' and FFMPEG_AVAILABLE:
-            postprocessors = [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}]
-        else:
-            postprocessors = []
+        await safe_edit_message(context, user_id, message_id, "📤 **Uploading file...**")
         
-        download_type = format_type.upper() if format_type != 'audio' else 'AUDIO'
-        await safe_edit_message(context, user_id, message_id,
-            f"⏬ **Starting download...**\n\n📹 **Title:** {video_title}\n🎯 **Format:** {download_type}\n📺 **Quality:** {quality if format_type=='mp4' else 'Best Available'}\n🔧 **Method:** {successful_strategy}")
+        upload_started = time.monotonic()
+        total_size = 0
+        documents = job.documents()
+        for filename, path in documents:
+            size = media_size(path)
+            total_size += size
+            
+            sent = await asyncio.wait_for(
+                upload_document(context, user_id, path, filename),
+                timeout=get_upload_timeout(size) + 30
+            )
         
-        # Get enhanced options
-        ydl_opts = get_enhanced_ydl_opts(output_file, format_spec, postprocessors, my_hook)
+        stage_seconds.observe(time.monotonic() - upload_started, 'upload')
+        logger.info(f"⏱️ Uploaded {len(documents)} file(s) in {time.monotonic() - upload_started:.1f}s")
+        jobs_total.inc('ok')
         
-        # Add random delay before download
-        await asyncio.sleep(random.uniform(1, 2))
+        # Remember the file_id so identical requests skip download and upload
+        if len(documents) == 1 and sent.document:
+            write_behind(result_cache.put(cache_key, sent.document, filename), f"result cache {cache_key}")
         
-        await main_loop.run_in_executor(None, download_with_ytdlp, ydl_opts, url)
-        await safe_edit_message(context, user_id, message_id, "📤 **Uploading file...**")
-
-        # Find and upload the downloaded file
-        for file in os.listdir(output_dir):
-            if file.startswith(f"{user_id}_{timestamp}"):
-                file_path = os.path.join(output_dir, file)
-                file_size = os.path.getsize(file_path)
-                
-                if file_size > 50*1024*1024:
-                    await safe_edit_message(context, user_id, message_id, 
-                        f"❌ **File too large** ({file_size/(1024*1024):.1f}MB > 50MB)\n\n"
-                        "Try selecting a lower quality option.")
-                else:
-                    # Determine appropriate filename
-                    file_ext = os.path.splitext(file)[1]
-                    filename = f"{video_title}{file_ext}"
-                    
-                    with open(file_path, 'rb') as f:
-                        await asyncio.wait_for(
-                            context.bot.send_document(
-                                chat_id=user_id, 
-                                document=f, 
-                                filename=filename
-                            ), 
-                            timeout=120
-                        )
-                    
-                    await asyncio.wait_for(
-                        context.bot.send_message(
-                            chat_id=user_id, 
-                            text=f"✅ **Download completed!**\n\n"
-                                 f"📋 **Format:** {download_type}\n"
-                                 f"📊 **Quality:** {quality if format_type=='mp4' else 'Best Available'}\n"
-                                 f"📦 **Size:** {file_size/(1024*1024):.1f}MB", 
-                            parse_mode='Markdown'
-                        ), 
-                        timeout=30
-                    )
-                    
-                    try:
-                        await context.bot.delete_message(chat_id=user_id, message_id=message_id)
-                    except:
-                        pass
-                
-                # Clean up file
-                try:
-                    os.remove(file_path)
-                except:
-                    pass
-                break
-        else:
-            await safe_edit_message(context, user_id, message_id, "❌ **Download failed** - No output file generated")
+        parts_text = f"\n🧩 **Parts:** {len(documents)}" if len(documents) > 1 else ""
+        await asyncio.wait_for(
+            context.bot.send_message(
+                chat_id=user_id, 
+                text=f"✅ **Download completed!**\n\n"
+                     f"📋 **Format:** {download_type}\n"
+                     f"📊 **Quality:** {quality_label}\n"
+                     f"📦 **Size:** {total_size/(1024*1024):.1f}MB{parts_text}", 
+                parse_mode='Markdown'
+            ), 
+            timeout=30
+        )
+        
+        try:
+            await context.bot.delete_message(chat_id=user_id, message_id=message_id)
+        except:
+            pass
                 
     except Exception as e:
         logger.error(f"Download error: {e}")
-        error_msg = str(e).lower()
+        error_class = classify_download_error(e)
+        jobs_total.inc(error_class)
         
-        if "network connectivity" in error_msg or "failed to resolve" in error_msg:
+        if error_class == 'no_content':
+            await safe_edit_message(context, user_id, message_id, 
+                "❌ **No downloadable content found**\n\n"
+                "This video may be:\n"
+                "• A live stream or premiere\n"
+                "• Region/age restricted\n"
+                "• Private or deleted\n"
+                "• Contains only images\n\n"
+                "Please try a different video.")
+        elif error_class == 'no_output':
+            await safe_edit_message(context, user_id, message_id, "❌ **Download failed** - No output file generated")
+        elif error_class == 'too_large':
+            await safe_edit_message(context, user_id, message_id, 
+                f"❌ **File too large** ({job.size/(1024*1024):.1f}MB > {MAX_UPLOAD_SIZE/(1024*1024):.0f}MB)\n\n"
+                "Try selecting a lower quality option.")
+        elif error_class == 'network':
             await safe_edit_message(context, user_id, message_id, 
                 "❌ **Network Error**\n\n"
                 "Connection issues detected. This may be temporary.\n"
                 "Please try again in a few minutes.")
-        elif "no downloadable content" in error_msg or "only images" in error_msg:
+        elif error_class == 'unavailable':
             await safe_edit_message(context, user_id, message_id, 
                 "❌ **Content Not Available**\n\n"
                 "This video doesn't have downloadable audio/video content.\n"
                 "It may be a live stream, image post, or restricted content.")
-        elif "ffmpeg" in error_msg:
+        elif error_class == 'busy':
+            await safe_edit_message(context, user_id, message_id, 
+                "⏳ **Too Many Downloads**\n\n"
+                f"{e}.\n"
+                "Please wait for your current downloads to finish and try again.")
+        elif error_class == 'ffmpeg':
             await safe_edit_message(context, user_id, message_id, 
                 "❌ **Audio Processing Failed**\n\n"
                 "Try downloading as MP4 instead, or contact support.")
-        elif "sign in" in error_msg or "bot" in error_msg:
+        elif error_class == 'blocked':
             await safe_edit_message(context, user_id, message_id, 
                 "❌ **Access Blocked**\n\n"
                 "YouTube has temporarily blocked this request.\n"
@@ -611,16 +3030,46 @@ async def download_video(update: Update, context: CallbackContext):
             
     finally:
         # Clean up
-        user_messages.pop(user_id, None)
-        last_percent.pop(user_id, None)
-        last_update_time.pop(user_id, None)
-        user_formats.pop(user_id, None)
+        await progress.stop()
+        await sessions.pop(session.token)
+        job.close()
 
-def download_with_ytdlp(ydl_opts, url):
-    """Download with improved retry mechanism"""
+def classify_download_error(error):
+    """Bucket a download failure for the user-facing message and the jobs_total metric"""
+    if isinstance(error, JobError):
+        return error.error_class
+    error_msg = str(error).lower()
+    if "network connectivity" in error_msg or "failed to resolve" in error_msg:
+        return 'network'
+    if "no downloadable content" in error_msg or "only images" in error_msg:
+        return 'unavailable'
+    if "queue is full" in error_msg:
+        return 'busy'
+    if "ffmpeg" in error_msg:
+        return 'ffmpeg'
+    if "sign in" in error_msg or "bot" in error_msg:
+        return 'blocked'
+    return 'error'
+
+def timed_stage(stage, func, *args):
+    """Run func(*args) and record its duration under stage (called on a worker thread)"""
+    started = time.monotonic()
+    try:
+        return func(*args)
+    finally:
+        seconds = time.monotonic() - started
+        stage_seconds.observe(seconds, stage)
+        logger.info(f"⏱️ Stage {stage}: {seconds:.1f}s")
+
+def download_with_ytdlp(ydl_opts, url, info=None):
+    """Download with improved retry mechanism, reusing the probed info when possible.
+    Returns the final info dict of the downloaded video."""
+    import yt_dlp
     max_retries = 2
     
     for attempt in range(max_retries):
+        # Only the first attempt trusts the probed info; retries re-extract from scratch
+        reuse_info = attempt == 0 and is_info_fresh(info)
         try:
             # Add delay between attempts
             if attempt > 0:
@@ -630,9 +3079,14 @@ def download_with_ytdlp(ydl_opts, url):
                 if 'extractor_args' in ydl_opts:
                     ydl_opts['extractor_args']['youtube']['player_client'] = ['android', 'web'][attempt % 2]
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-            return  # Success
+            with cookie_manager.checkout() as cookiefile:
+                opts = dict(ydl_opts, cookiefile=cookiefile) if cookiefile else ydl_opts
+                with yt_dlp.YoutubeDL(opts) as ydl, download_tuner.limit(ydl.params, info if reuse_info else None):
+                    if reuse_info:
+                        return ydl.process_ie_result(ydl.sanitize_info(copy.deepcopy(info)), download=True)
+                    if info is not None:
+                        logger.info("Probed info expired or unusable, re-extracting")
+                    return ydl.extract_info(url, download=True)
             
         except Exception as e:
             logger.error(f"Download attempt {attempt + 1} failed: {e}")
@@ -643,44 +3097,470 @@ def download_with_ytdlp(ydl_opts, url):
 async def handle_special_callbacks(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
+    action, token = parse_callback(query.data)
+    session = await sessions.get(token)
     
-    if query.data == 'audio_original':
+    if action == 'audio_original':
+        if not session:
+            await query.edit_message_text("❌ URL not found. Please send it again.")
+            return
         # Set format to audio and proceed with download
-        user_id = query.message.chat_id
-        user_formats[user_id] = 'audio'
-        # Simulate quality selection
-        query.data = 'best'
-        await download_video(update, context)
-    elif query.data == 'cancel':
+        session.format_type = 'audio'
+        await sessions.save(session)
+        await download_video(query, context, session, 'best')
+    elif action == 'cancel':
+        prefetcher.discard(token)
+        await sessions.pop(token)
         await query.edit_message_text("❌ Download cancelled.")
 
-def main():
-    TOKEN = os.getenv("BOT_TOKEN")
-    if not TOKEN:
-        raise ValueError("❌ BOT_TOKEN environment variable is not set!")
+# Batch settings: several links, or a playlist, in one message become a single job
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "25"))
+# Items of one batch in flight at once; also the batch's own per-user download allowance
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", "3"))
+ALBUM_SIZE = 10  # Telegram's limit for one media group
+BATCH_OPTIONS = {'mp3': ('mp3', 'best'), 'm4a': ('m4a', 'best'), '720': ('mp4', '720'), 'best': ('mp4', 'best')}
+BATCH_STATE_ICONS = {'queued': '⏳', 'probing': '🔍', 'downloading': '⏬', 'converting': '🎛️',
+                     'ready': '📦', 'uploading': '📤', 'sent': '✅', 'failed': '❌'}
+BATCH_ERRORS = {'network': 'network error', 'unavailable': 'no downloadable content',
+                'no_content': 'no downloadable content', 'busy': 'server busy',
+                'ffmpeg': 'conversion failed', 'blocked': 'blocked by the site', 'too_large': 'file too large',
+                'no_output': 'no output file', 'error': 'download failed'}
+
+class BatchItem:
+    """One video of a batch job and how far it has got"""
+
+    __slots__ = ('url', 'title', 'state', 'latest', 'job', 'cache_key', 'cached', 'size', 'error')
+
+    def __init__(self, url, title=None):
+        self.url = url
+        self.title = title
+        self.state = 'queued'
+        self.latest = None  # last yt-dlp progress dict
+        self.job = None  # MediaJob once the item is being downloaded
+        self.cache_key = None
+        self.cached = None  # result cache entry when this file was uploaded before
+        self.size = 0
+        self.error = None  # error class once failed
+
+    def hook(self, d):
+        """yt-dlp progress hook; runs on the download thread and only overwrites the slot"""
+        self.latest = d
+
+    def fail(self, error_class):
+        self.state = 'failed'
+        self.error = error_class
 
-    # Log system status
-    logger.info(f"FFmpeg available: {FFMPEG_AVAILABLE}")
-    logger.info(f"FFprobe available: {FFPROBE_AVAILABLE}")
-    logger.info(f"Network connectivity: {check_network()}")
+    def render(self):
+        line = f"{BATCH_STATE_ICONS[self.state]} {escape_markdown(self.title or self.url[:50])}"
+        d = self.latest
+        if self.state == 'downloading' and d and d.get('status') == 'downloading':
+            total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if total_bytes:
+                line += f" - {min(d.get('downloaded_bytes', 0) / total_bytes * 100, 100):.0f}%"
+        elif self.state == 'failed':
+            line += f" - {BATCH_ERRORS.get(self.error, BATCH_ERRORS['error'])}"
+        return line
+
+class BatchProgress(ProgressTracker):
+    """A single status message for a whole batch, listing the state of every item"""
+
+    __slots__ = ('items', 'details')
+
+    def __init__(self, context, chat_id, message_id, items, details):
+        super().__init__(context, chat_id, message_id)
+        self.items = items
+        self.details = details
+
+    def render(self):
+        done = sum(item.state in ('sent', 'failed') for item in self.items)
+        lines = '\n'.join(item.render() for item in self.items)
+        return f"📦 **Batch: {done} of {len(self.items)} done**\n{self.details}\n\n{lines}"
+
+def expand_playlist(url, limit):
+    """Flat-extract a playlist into (url, title) entries without resolving each video (called on an extraction worker)"""
+    opts = {
+        'quiet': True,
+        'extract_flat': 'in_playlist',
+        'noplaylist': False,
+        'playlistend': limit,
+        'socket_timeout': 30,
+        'force_ipv4': True,
+        'user_agent': random.choice(USER_AGENTS),
+    }
+    proxy = os.getenv('PROXY_URL')
+    if proxy:
+        opts['proxy'] = proxy
+    info = extract_info_blocking(opts, url)
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        return [(info.get('webpage_url') or url, info.get('title'))]
+    entries = []
+    for entry in info.get('entries') or []:
+        entry_url = entry and (entry.get('url') or entry.get('webpage_url'))
+        # Flat entries of a few extractors only carry an ID; those can't be probed on their own
+        if entry_url and URL_PATTERN.match(entry_url):
+            entries.append((entry_url, entry.get('title')))
+    return entries[:limit]
+
+async def expand_batch(urls):
+    """Resolve the links of a batch into items, with one flat extraction per playlist"""
+    playlists = [url for url in urls if is_playlist_url(url)]
+    results = await asyncio.gather(*(extraction_pool.run(expand_playlist, url, BATCH_MAX_ITEMS, label="Expand playlist")
+                                     for url in playlists), return_exceptions=True)
+    expanded = dict(zip(playlists, results))
+    
+    items, seen = [], set()
+    for url in urls:
+        entries = expanded.get(url, [(url, None)])
+        if isinstance(entries, Exception):
+            logger.error(f"Could not expand playlist {url}: {entries}")
+            item = BatchItem(url)
+            item.fail(classify_download_error(entries))
+            items.append(item)
+            continue
+        for entry_url, title in entries:
+            key = get_video_key(entry_url)
+            if key not in seen:
+                seen.add(key)
+                items.append(BatchItem(entry_url, clean_title(title, '') or None))
+    if len(items) > BATCH_MAX_ITEMS:
+        logger.info(f"📦 Batch trimmed from {len(items)} to {BATCH_MAX_ITEMS} items")
+    return items[:BATCH_MAX_ITEMS]
+
+async def process_batch_item(session, item, quality):
+    """Run one batch item's MediaJob; a failure only affects this item"""
+    format_type = session.format_type
+    item.cache_key = result_cache.make_key(item.url, format_type, quality)
+    item.cached = await result_cache.get(item.cache_key)
+    if item.cached:
+        item.title = item.title or os.path.splitext(item.cached['filename'])[0]
+        item.state = 'ready'
+        return
+    
+    item.job = MediaJob(item.url, format_type, quality, session.user_id, f"{session.chat_id}_{session.token}",
+                        max_active=BATCH_PARALLELISM)
+    
+    async def show_stage(stage):
+        item.state = 'converting' if stage == 'fitting' else stage
+        if item.job.title:
+            item.title = item.job.title
+    
+    try:
+        await item.job.run(item.hook, show_stage, fallback_title=item.title or get_video_key(item.url))
+        item.state = 'ready'
+    except Exception as e:
+        logger.error(f"Batch item {item.url} failed: {e}")
+        item.fail(classify_download_error(e))
+
+async def send_batch_document(context: CallbackContext, chat_id, item, filename, path):
+    """Send one batch document on its own; returns the Message, or None after marking the item failed"""
+    try:
+        if item.cached:
+            return await asyncio.wait_for(
+                context.bot.send_document(chat_id=chat_id, document=item.cached['file_id']), timeout=30)
+        return await asyncio.wait_for(upload_document(context, chat_id, path, filename),
+                                      timeout=get_upload_timeout(media_size(path)) + 30)
+    except Exception as e:
+        logger.error(f"Batch upload of {filename} failed: {e}")
+        if item.cached and isinstance(e, BadRequest):
+            await result_cache.invalidate(item.cache_key, str(e))
+        item.fail(classify_download_error(e))
+        return None
 
-    request = HTTPXRequest(
-        connection_pool_size=8, 
+async def send_batch_items(context: CallbackContext, chat_id, items):
+    """Upload the finished items in their original order, grouped into albums of up to ALBUM_SIZE documents"""
+    documents = []  # (item, filename, path); path is None for cached file_ids
+    for item in items:
+        if item.state != 'ready':
+            continue
+        if item.cached:
+            item.size = item.cached.get('file_size') or 0
+            documents.append((item, item.cached['filename'], None))
+            continue
+        for filename, path in item.job.documents():
+            item.size += media_size(path)
+            documents.append((item, filename, path))
+    
+    for start in range(0, len(documents), ALBUM_SIZE):
+        group = documents[start:start + ALBUM_SIZE]
+        for item, _, _ in group:
+            if item.state != 'failed':
+                item.state = 'uploading'
+        upload_started = time.monotonic()
+        
+        sent = None
+        if len(group) > 1:
+            size = sum(media_size(path) for _, _, path in group if path)
+            try:
+                sent = await asyncio.wait_for(
+                    upload_media_group(context, chat_id, [(filename, path, item.cached['file_id'] if item.cached else None)
+                                                          for item, filename, path in group]),
+                    timeout=get_upload_timeout(size) + 30
+                )
+            except Exception as e:
+                # An album is all or nothing; one by one, a bad file only fails its own item
+                logger.warning(f"Album upload failed, sending {len(group)} files one by one: {e}")
+        if sent is None:
+            sent = [await send_batch_document(context, chat_id, *document) for document in group]
+        stage_seconds.observe(time.monotonic() - upload_started, 'upload')
+        
+        for (item, filename, path), message in zip(group, sent):
+            if message is None or item.state == 'failed':
+                continue
+            item.state = 'sent'
+            # Remember the file_id so identical requests skip download and upload
+            if not item.cached and len(item.job.paths) == 1 and message.document:
+                write_behind(result_cache.put(item.cache_key, message.document, filename), f"result cache {item.cache_key}")
+
+async def choose_batch(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    choice, token = parse_callback(query.data)
+    session = await sessions.get(token)
+    if not session or not session.urls:
+        await query.edit_message_text("❌ Links not found. Please send them again.")
+        return
+    
+    format_type, quality = BATCH_OPTIONS[choice.partition('_')[2]]
+    # Without FFmpeg, audio batches keep the original audio format
+    if format_type in AUDIO_TARGETS and not FFMPEG_AVAILABLE:
+        format_type = 'audio'
+    session.format_type = format_type
+    await sessions.save(session)
+    await run_batch(query, context, session, quality)
+
+async def run_batch(query, context: CallbackContext, session, quality):
+    user_id = session.chat_id
+    format_type = session.format_type
+    trace_id_var.set(secrets.token_hex(4))
+    logger.info(f"Batch for {user_id}: {format_type} {quality}, {len(session.urls)} links")
+
+    message = await query.edit_message_text("🔍 Expanding links...")
+    message_id = message.message_id
+
+    items, tasks = [], []
+    download_type = format_type.upper() if format_type != 'audio' else 'AUDIO'
+    quality_label = quality if format_type == 'mp4' else 'Best Available'
+    progress = BatchProgress(context, user_id, message_id, items,
+                             f"🎯 **Format:** {download_type}\n📺 **Quality:** {quality_label}")
+
+    try:
+        # Network down: keep the batch queued until it's back rather than failing it
+        if not health.online:
+            await safe_edit_message(context, user_id, message_id,
+                "📡 **Network is unavailable**\n\nYour batch is queued and will start once the connection is back.")
+            if not await health.wait_online(HEALTH_OFFLINE_WAIT):
+                raise Exception("Network connectivity issues detected")
+        
+        items.extend(await expand_batch(session.urls))
+        if not items:
+            raise Exception("No downloadable content found")
+        progress.start()
+        
+        # Bounded fan-out: items download side by side on BATCH_PARALLELISM slots of their own, still
+        # under the global cap and the scheduler's round-robin, so other users keep getting their turns.
+        # Never more in flight than the per-user queue accepts, so waiting items aren't rejected
+        limit = asyncio.Semaphore(max(1, min(BATCH_PARALLELISM, MAX_QUEUED_PER_USER)))
+        
+        async def process(item):
+            if item.state == 'queued':
+                async with limit:
+                    await process_batch_item(session, item, quality)
+        
+        tasks = [asyncio.create_task(process(item)) for item in items]
+        # Albums go out in order as soon as their items are done, while later items keep downloading
+        for start in range(0, len(items), ALBUM_SIZE):
+            chunk = items[start:start + ALBUM_SIZE]
+            await asyncio.gather(*tasks[start:start + ALBUM_SIZE])
+            try:
+                await send_batch_items(context, user_id, chunk)
+            finally:
+                for item in chunk:
+                    if item.job:
+                        item.job.close()
+        await progress.stop()
+        
+        sent = [item for item in items if item.state == 'sent']
+        failed = [item for item in items if item.state == 'failed']
+        for item in items:
+            jobs_total.inc(item.error if item.state == 'failed' else 'cached' if item.cached else 'ok')
+        logger.info(f"📦 Batch for {user_id} finished: {len(sent)} of {len(items)} sent")
+        
+        failed_text = ("\n\n**Failed:**\n" + '\n'.join(item.render() for item in failed)) if failed else ""
+        await safe_edit_message(context, user_id, message_id,
+            f"{'✅' if sent else '❌'} **Batch finished: {len(sent)} of {len(items)} sent**\n\n"
+            f"📋 **Format:** {download_type}\n"
+            f"📊 **Quality:** {quality_label}\n"
+            f"📦 **Size:** {sum(item.size for item in sent)/(1024*1024):.1f}MB{failed_text}")
+    
+    except Exception as e:
+        logger.error(f"Batch error: {e}")
+        jobs_total.inc(classify_download_error(e))
+        await safe_edit_message(context, user_id, message_id, 
+            f"❌ **Batch Failed**\n\n"
+            f"Error: {str(e)[:100]}...\n\n"
+            f"Please check the links and try again.")
+    
+    finally:
+        await progress.stop()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await sessions.pop(session.token)
+        for item in items:
+            if item.job:
+                item.job.close()
+
+# Server / update delivery settings
+PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL; enables webhook mode when set
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Required with WEBHOOK_URL; every replica behind the URL must share it
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Discard updates queued while the webhook was being (re)registered; off so replica restarts lose nothing
+WEBHOOK_DROP_PENDING = os.getenv("WEBHOOK_DROP_PENDING", "false").lower() in ('1', 'true', 'yes')
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+bot_status = {'mode': None, 'ready': False, 'started_at': time.time()}
+
+metrics.register(Gauge("active_jobs", "Downloads currently running", callback=lambda: download_scheduler.active_total))
+metrics.register(Gauge("queued_jobs", "Downloads waiting for a slot", callback=lambda: download_scheduler.queue_length()))
+metrics.register(Gauge("pool_pending", "Jobs submitted to a worker pool and not yet finished", ('pool',),
+                       callback=lambda: {(pool.name,): pool.pending for pool in (extraction_pool, transcode_pool)}))
+metrics.register(Gauge("downloads_disk_bytes", "Bytes used under the downloads directory as of the last sweep",
+                       callback=lambda: janitor.usage))
+
+def create_web_app(application):
+    """aiohttp app serving the Telegram webhook and health/readiness endpoints"""
+
+    async def handle_webhook(request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook payload: {e}")
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_health(request):
+        # Stays 200 while degraded: a restart won't bring the network back
+        body = health.snapshot()
+        body['uptime'] = round(time.time() - bot_status['started_at'])
+        return web.json_response(body)
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    async def handle_ready(request):
+        body = {'ready': bot_status['ready'], 'mode': bot_status['mode']}
+        return web.json_response(body, status=200 if bot_status['ready'] else 503)
+
+    web_app = web.Application()
+    web_app.router.add_get("/health", handle_health)
+    web_app.router.add_get("/ready", handle_ready)
+    web_app.router.add_get("/metrics", handle_metrics)
+    if WEBHOOK_URL:
+        web_app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    return web_app
+
+def warm_up():
+    """Load yt-dlp and its extractor list off the event loop so the first request doesn't pay for it"""
+    started = time.perf_counter()
+    import yt_dlp  # noqa: F401
+    get_extractor_classes()
+    # Matching a URL no extractor claims compiles every _VALID_URL regex once
+    get_url_extractor('https://warmup.invalid/')
+    logger.info(f"🔥 yt-dlp warmed up in {time.perf_counter() - started:.2f}s")
+
+async def run_bot(application):
+    """Run the bot in webhook or polling mode next to the HTTP server until SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # Capability checks, heavy imports, cookies and the HTTP server all come up
+    # in the background while the bot connects to Telegram
+    health_task = asyncio.create_task(health.run())
+    lag_task = asyncio.create_task(loop_lag_monitor.run())
+    warm_task = asyncio.create_task(asyncio.to_thread(warm_up))
+    cookie_task = asyncio.create_task(cookie_manager.run())
+    janitor_task = asyncio.create_task(janitor.run())
+    web_runner = web.AppRunner(create_web_app(application), access_log=None)
+    await web_runner.setup()
+    await web.TCPSite(web_runner, "0.0.0.0", PORT).start()
+    logger.info(f"🌐 HTTP server listening on port {PORT}")
+
+    async with application:
+        await application.start()
+
+        if WEBHOOK_URL:
+            bot_status['mode'] = 'webhook'
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                drop_pending_updates=WEBHOOK_DROP_PENDING,
+                max_connections=min(max(CONCURRENT_UPDATES, 1), 100)
+            )
+        else:
+            bot_status['mode'] = 'polling'
+            await application.updater.start_polling(drop_pending_updates=True)
+        bot_status['ready'] = True
+        logger.info(f"🤖 Bot is running ({bot_status['mode']} mode, {CONCURRENT_UPDATES} concurrent updates)...")
+        logger.info(f"🚀 Ready {time.perf_counter() - STARTUP_BEGAN:.2f}s after launch "
+                    f"(imports {IMPORTS_DONE - STARTUP_BEGAN:.2f}s)")
+
+        await stop_event.wait()
+
+        bot_status['ready'] = False
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+
+    for task in (cookie_task, janitor_task, health_task, lag_task, warm_task):
+        task.cancel()
+    await web_runner.cleanup()
+
+def build_application(token):
+    """Configure the Application and register the handlers"""
+    request = MeteredRequest(
+        connection_pool_size=max(8, CONCURRENT_UPDATES), 
         read_timeout=60, 
         write_timeout=60, 
         connect_timeout=15, 
         pool_timeout=15
     )
     
-    app = ApplicationBuilder().token(TOKEN).request(request).build()
+    builder = ApplicationBuilder().token(token).request(request).concurrent_updates(CONCURRENT_UPDATES)
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    if BOT_API_FILE_URL:
+        builder = builder.base_file_url(BOT_API_FILE_URL)
+    if BOT_API_LOCAL_MODE:
+        builder = builder.local_mode(True)
+    logger.info(f"Bot API: {BOT_API_URL or 'api.telegram.org'} (local mode: {BOT_API_LOCAL_MODE}, "
+                f"upload limit: {MAX_UPLOAD_SIZE / (1024 * 1024):.0f}MB)")
+    
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    app.add_handler(CallbackQueryHandler(choose_quality, pattern='^(mp3|mp4)$'))
-    app.add_handler(CallbackQueryHandler(download_video, pattern='^(360|480|720|1080|best)$'))
-    app.add_handler(CallbackQueryHandler(handle_special_callbacks, pattern='^(audio_original|cancel)$'))
-    
-    logger.info("🤖 Bot is running...")
-    app.run_polling(drop_pending_updates=True)
+    app.add_handler(CallbackQueryHandler(choose_quality, pattern='^(mp3|m4a|mp4):'))
+    app.add_handler(CallbackQueryHandler(choose_download, pattern='^(360|480|720|1080|best):'))
+    app.add_handler(CallbackQueryHandler(handle_special_callbacks, pattern='^(audio_original|cancel):'))
+    app.add_handler(CallbackQueryHandler(choose_batch, pattern='^batch_(mp3|m4a|720|best):'))
+    return app
+
+def main():
+    TOKEN = os.getenv("BOT_TOKEN")
+    if not TOKEN:
+        raise ValueError("❌ BOT_TOKEN environment variable is not set!")
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise ValueError("❌ WEBHOOK_SECRET must be set (and shared by every replica) when WEBHOOK_URL is set!")
+
+    asyncio.run(run_bot(build_application(TOKEN)))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,71 @@
+"""Fake media origin for the load test.
+
+Serves video metadata from /api/video/<id> and throttled synthetic media from
+/media/<id>/<format_id>. The fakeorigin yt-dlp extractor in
+yt_dlp_plugins/extractor/fake_origin.py turns its /watch?v=<id> URLs into formats.
+"""
+import asyncio
+import os
+
+from aiohttp import web
+
+BLOCK_SIZE = 64 * 1024
+
+class OriginConfig:
+    def __init__(self, video_size, audio_size, rate, probe_latency, duration=180):
+        self.video_size = video_size
+        self.audio_size = audio_size
+        self.rate = rate  # bytes/s per connection, 0 = unthrottled
+        self.probe_latency = probe_latency
+        self.duration = duration
+
+def get_formats(config, base_url, video_id):
+    media = f"{base_url}/media/{video_id}"
+    duration = config.duration
+    return [
+        {'format_id': '140', 'url': f"{media}/140", 'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none',
+         'abr': config.audio_size * 8 / 1000 / duration, 'filesize': config.audio_size},
+        {'format_id': '18', 'url': f"{media}/18", 'ext': 'mp4', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1.42001E',
+         'height': 360, 'width': 640, 'fps': 30, 'filesize': config.video_size // 2,
+         'tbr': config.video_size // 2 * 8 / 1000 / duration},
+        {'format_id': '22', 'url': f"{media}/22", 'ext': 'mp4', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1.64001F',
+         'height': 720, 'width': 1280, 'fps': 30, 'filesize': config.video_size,
+         'tbr': config.video_size * 8 / 1000 / duration},
+    ]
+
+def create_origin_app(config):
+    block = os.urandom(BLOCK_SIZE)
+    sizes = {'140': config.audio_size, '18': config.video_size // 2, '22': config.video_size}
+
+    async def handle_info(request):
+        await asyncio.sleep(config.probe_latency)
+        video_id = request.match_info['video_id']
+        base_url = f"{request.scheme}://{request.host}"
+        return web.json_response({
+            'id': video_id,
+            'title': f"Synthetic video {video_id}",
+            'duration': config.duration,
+            'formats': get_formats(config, base_url, video_id),
+        })
+
+    async def handle_media(request):
+        size = sizes.get(request.match_info['format_id'])
+        if size is None:
+            raise web.HTTPNotFound()
+        response = web.StreamResponse(headers={'Content-Type': 'application/octet-stream',
+                                               'Content-Length': str(size)})
+        await response.prepare(request)
+        sent = 0
+        while sent < size:
+            chunk = block[:min(BLOCK_SIZE, size - sent)]
+            await response.write(chunk)
+            sent += len(chunk)
+            if config.rate:
+                await asyncio.sleep(len(chunk) / config.rate)
+        await response.write_eof()
+        return response
+
+    origin = web.Application()
+    origin.router.add_get('/api/video/{video_id}', handle_info)
+    origin.router.add_get('/media/{video_id}/{format_id}', handle_media)
+    return origin
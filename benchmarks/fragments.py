@@ -0,0 +1,110 @@
+"""Compare the standard and fast download profiles against a local fragmented stream.
+
+Serves a synthetic HLS playlist from a throttled local HTTP server, then downloads it
+with the options app.py would build for each profile and reports the throughput.
+
+    python benchmarks/fragments.py --segments 40 --segment-kb 512 --latency 0.05
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp
+
+import app
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """Serves stream.m3u8 and its segments; every request pays a fixed latency and a
+    per-connection throughput cap, like a CDN edge far away from the bot"""
+
+    segments = 0
+    payload = b''
+    latency = 0.0
+    connection_rate = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.path == '/stream.m3u8':
+            lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:0']
+            for i in range(self.segments):
+                lines += ['#EXTINF:2.0,', f'seg{i}.ts']
+            lines.append('#EXT-X-ENDLIST')
+            body = '\n'.join(lines).encode()
+            self._send(body, 'application/vnd.apple.mpegurl')
+        elif self.path.startswith('/seg'):
+            self._send(self.payload, 'video/mp2t', throttle=True)
+        else:
+            self.send_error(404)
+
+    def _send(self, body, content_type, throttle=False):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        block = 64 * 1024
+        for offset in range(0, len(body), block):
+            self.wfile.write(body[offset:offset + block])
+            if throttle and self.connection_rate:
+                time.sleep(block / self.connection_rate)
+
+def run_profile(profile, url, runs):
+    app.DOWNLOAD_PROFILE = profile
+    timings = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as job_dir:
+            opts = app.get_enhanced_ydl_opts(os.path.join(job_dir, 'media.%(ext)s'), 'best', [],
+                                             lambda d: None)
+            opts.update(quiet=True, noprogress=True, fixup='never', proxy=None)
+            started = time.perf_counter()
+            with yt_dlp.YoutubeDL(opts) as ydl, app.download_tuner.limit(ydl.params):
+                info = ydl.extract_info(url, download=True)
+            elapsed = time.perf_counter() - started
+            size = os.path.getsize(info['requested_downloads'][0]['filepath'])
+            timings.append((elapsed, size))
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--segments', type=int, default=40)
+    parser.add_argument('--segment-kb', type=int, default=512)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every request')
+    parser.add_argument('--connection-mbps', type=float, default=40, help='per-connection cap, 0 = none')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    StreamHandler.segments = args.segments
+    StreamHandler.payload = os.urandom(args.segment_kb * 1024)
+    StreamHandler.latency = args.latency
+    StreamHandler.connection_rate = int(args.connection_mbps * 1024 * 1024 / 8)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StreamHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/stream.m3u8'
+
+    try:
+        results = {profile: run_profile(profile, url, args.runs) for profile in ('standard', 'fast')}
+    finally:
+        server.shutdown()
+
+    print(f"{args.segments} x {args.segment_kb} KB segments, {args.latency * 1000:.0f} ms latency, "
+          f"{args.connection_mbps:g} Mbit/s per connection, {args.runs} runs")
+    speeds = {}
+    for profile, timings in results.items():
+        best = min(elapsed for elapsed, _ in timings)
+        size = timings[0][1]
+        speeds[profile] = size / best
+        print(f"  {profile:<8} best {best:6.2f}s  {size / best / 1024 / 1024:7.2f} MB/s")
+    print(f"  speedup  {speeds['fast'] / speeds['standard']:.2f}x "
+          f"({app.FRAGMENT_CONCURRENCY} concurrent fragments)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""Offline load test: replays concurrent users through the bot against local fakes.
+
+A child process runs the stub Bot API (stub_bot_api.py) and the fake media origin
+(fake_origin.py). This process runs the real bot, pointed at the stub, and a driver
+that takes each user through /start -> link -> format -> quality -> upload.
+
+    python benchmarks/loadtest.py --users 20 --video-mb 8 --origin-mbps 80
+
+Reports p50/p95/p99 time to first progress and time to file (both measured from the
+quality tap), event loop lag, Bot API call counts and peak RSS.
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_origin import OriginConfig, create_origin_app
+from stub_bot_api import StubState, create_stub_app, parse_keyboard
+
+TOKEN = '123456:LOADTEST'
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def serve_fixtures(stub_port, origin_port, origin_config):
+    """Child process: stub Bot API and fake origin on one event loop"""
+    from aiohttp import web
+
+    async def serve():
+        runners = []
+        for web_app, port in ((create_stub_app(StubState()), stub_port), (create_origin_app(origin_config), origin_port)):
+            runner = web.AppRunner(web_app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', port).start()
+            runners.append(runner)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(name, values, unit='s', scale=1):
+    if not values:
+        return f"  {name:<22} no samples"
+    values = [v * scale for v in values]
+    return (f"  {name:<22} p50 {percentile(values, 50):8.3f}{unit}  p95 {percentile(values, 95):8.3f}{unit}  "
+            f"p99 {percentile(values, 99):8.3f}{unit}  max {max(values):8.3f}{unit}  (n={len(values)})")
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes up from a short sleep"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - started - self.interval)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self.task.cancel()
+
+class Driver:
+    """Plays one scripted user per chat against the stub's control API"""
+
+    def __init__(self, client, stub_url, origin_url, args):
+        self.client = client
+        self.stub_url = stub_url
+        self.origin_url = origin_url
+        self.args = args
+        self.message_ids = {}
+
+    async def push(self, update):
+        await self.client.post(f"{self.stub_url}/_control/updates", json=update)
+
+    def user(self, chat_id):
+        return {'id': chat_id, 'is_bot': False, 'first_name': f"user{chat_id}"}
+
+    async def send_text(self, chat_id, text):
+        self.message_ids[chat_id] = self.message_ids.get(chat_id, 0) + 1
+        message = {'message_id': 10000 + self.message_ids[chat_id], 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}, 'from': self.user(chat_id), 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        await self.push({'message': message})
+
+    async def tap(self, chat_id, message_id, data):
+        await self.push({'callback_query': {
+            'id': uuid.uuid4().hex, 'from': self.user(chat_id), 'chat_instance': str(chat_id), 'data': data,
+            'message': {'message_id': message_id, 'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'private'},
+                        'from': {'id': 1, 'is_bot': True, 'first_name': 'LoadTestBot'}, 'text': '...'},
+        }})
+
+    async def events(self, chat_id, after):
+        response = await self.client.get(f"{self.stub_url}/_control/events",
+                                         params={'chat_id': chat_id, 'after': after, 'timeout': 30})
+        return response.json()
+
+    async def wait_for(self, chat_id, after, match):
+        """Next bot event for chat_id after seq that satisfies match; returns (event, seq)"""
+        deadline = time.monotonic() + self.args.timeout
+        while time.monotonic() < deadline:
+            for event in await self.events(chat_id, after):
+                after = event['seq']
+                if '❌' in event['text']:
+                    raise RuntimeError(event['text'].splitlines()[0])
+                if match(event):
+                    return event, after
+        raise TimeoutError(f"chat {chat_id} timed out")
+
+    async def run_user(self, index):
+        args = self.args
+        chat_id = 100000 + index
+        await asyncio.sleep(index * args.ramp / max(args.users, 1))
+        video_id = 'shared' if args.same_video else f"vid{index:05d}"
+
+        await self.send_text(chat_id, '/start')
+        _, seq = await self.wait_for(chat_id, 0, lambda e: e['method'] == 'sendMessage')
+
+        await self.send_text(chat_id, f"{self.origin_url}/watch?v={video_id}")
+        event, seq = await self.wait_for(
+            chat_id, seq, lambda e: any(d.startswith('mp4:') for d in parse_keyboard(e['reply_markup'])))
+        token = next(d for d in parse_keyboard(event['reply_markup']) if d.startswith('mp4:')).split(':', 1)[1]
+        message_id = event['message_id']
+
+        await asyncio.sleep(args.think)
+        await self.tap(chat_id, message_id, f"mp4:{token}")
+        _, seq = await self.wait_for(
+            chat_id, seq, lambda e: f"{args.quality}:{token}" in parse_keyboard(e['reply_markup']))
+        await asyncio.sleep(args.think)
+        tapped = time.time()
+        await self.tap(chat_id, message_id, f"{args.quality}:{token}")
+
+        first_progress = None
+
+        def progress_or_file(event):
+            nonlocal first_progress
+            if first_progress is None and event['method'] == 'editMessageText' and 'Downloading' in event['text']:
+                first_progress = event['t'] - tapped
+            return event['method'] == 'sendDocument'
+
+        event, seq = await self.wait_for(chat_id, seq, progress_or_file)
+        return first_progress, event['t'] - tapped
+
+async def run(args, stub_url, origin_url):
+    import app
+    from yt_dlp.plugins import load_all_plugins
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    load_all_plugins()  # registers the fakeorigin extractor from benchmarks/yt_dlp_plugins
+    await asyncio.to_thread(app.warm_up)
+
+    application = app.build_application(TOKEN)
+    lag = LoopLagMonitor()
+    async with httpx.AsyncClient(timeout=60) as client, application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=5)
+        driver = Driver(client, stub_url, origin_url, args)
+
+        lag.start()
+        started = time.perf_counter()
+        results = await asyncio.gather(*(driver.run_user(i) for i in range(args.users)), return_exceptions=True)
+        wall = time.perf_counter() - started
+        lag.stop()
+
+        stats = (await client.get(f"{stub_url}/_control/stats")).json()
+        await application.updater.stop()
+        await application.stop()
+
+    return args, results, wall, lag, stats
+
+def report(args, results, wall, lag, stats):
+    completed = [r for r in results if not isinstance(r, BaseException)]
+    failures = [r for r in results if isinstance(r, BaseException)]
+    print(f"\n{args.users} users, mp4 {args.quality}, "
+          f"{args.video_mb:g} MB video / {args.audio_mb:g} MB audio, origin {args.origin_mbps:g} Mbit/s per connection")
+    print(f"  completed {len(completed)}, failed {len(failures)} in {wall:.1f}s "
+          f"({len(completed) / wall * 60:.1f} files/min)")
+    for failure in failures[:5]:
+        print(f"    {type(failure).__name__}: {failure}")
+    print(summarize('time to first progress', [r[0] for r in completed if r[0] is not None]))
+    print(summarize('time to file', [r[1] for r in completed]))
+    print(summarize('event loop lag', lag.samples, 'ms', 1000))
+    print(f"  peak RSS               {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    print(f"  uploaded               {stats['upload_bytes'] / 1024 / 1024:.1f} MB")
+    print("  Bot API calls          " + ', '.join(f"{method} {count}" for method, count in sorted(stats['calls'].items())))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--ramp', type=float, default=1.0, help='seconds over which users arrive')
+    parser.add_argument('--think', type=float, default=0.5, help='seconds a user takes per tap')
+    # Synthetic media is random bytes, so only the MP4 flow (no FFmpeg step) is replayed
+    parser.add_argument('--quality', choices=('360', '480', '720', '1080', 'best'), default='720')
+    parser.add_argument('--video-mb', type=float, default=8)
+    parser.add_argument('--audio-mb', type=float, default=3)
+    parser.add_argument('--origin-mbps', type=float, default=80, help='per-connection origin speed, 0 = unthrottled')
+    parser.add_argument('--probe-latency', type=float, default=0.3, help='seconds the metadata API takes')
+    parser.add_argument('--same-video', action='store_true', help='every user requests the same video')
+    parser.add_argument('--timeout', type=float, default=300, help='per-user timeout in seconds')
+    parser.add_argument('--verbose', action='store_true', help='keep bot logs and yt-dlp output')
+    args = parser.parse_args()
+
+    stub_port, origin_port = free_port(), free_port()
+    origin_config = OriginConfig(int(args.video_mb * 1024 * 1024), int(args.audio_mb * 1024 * 1024),
+                                 int(args.origin_mbps * 1024 * 1024 / 8), args.probe_latency)
+    fixtures = multiprocessing.Process(target=serve_fixtures, args=(stub_port, origin_port, origin_config), daemon=True)
+    fixtures.start()
+
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    origin_url = f"http://127.0.0.1:{origin_port}"
+    for _ in range(100):
+        try:
+            httpx.get(f"{stub_url}/_control/stats")
+            break
+        except httpx.TransportError:
+            time.sleep(0.05)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        # The bot reads its settings at import time
+        os.environ.update({
+            'BOT_API_URL': f"{stub_url}/bot",
+            'STATE_BACKEND': 'memory',
+            'RESULT_CACHE_DB': os.path.join(scratch, 'results.db'),
+            'DOWNLOADS_DIR': os.path.join(scratch, 'downloads'),
+            'COOKIES_DIR': os.path.join(scratch, 'cookies'),
+        })
+        os.environ.pop('METADATA_CACHE_DB', None)
+        os.environ.pop('PROXY_URL', None)
+        # yt-dlp writes its own progress lines to stdout
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+        try:
+            with quiet:
+                outcome = asyncio.run(run(args, stub_url, origin_url))
+        finally:
+            fixtures.terminate()
+    report(*outcome)
+
+if __name__ == '__main__':
+    main()
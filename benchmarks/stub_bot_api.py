@@ -0,0 +1,167 @@
+"""Stub Telegram Bot API for the load test.
+
+Implements just enough of the Bot API for the bot's flows (long-polling getUpdates,
+messages, edits, callback answers, membership checks, multipart uploads and albums), and a
+small /_control API the driver uses to inject updates and watch what the bot sent.
+"""
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'LoadTestBot', 'username': 'loadtest_bot'}
+
+class StubState:
+    def __init__(self):
+        self.updates = []
+        self.next_update_id = 1
+        self.events = defaultdict(list)  # chat_id -> [event]
+        self.seq = 0
+        self.message_ids = Counter()
+        self.calls = Counter()
+        self.upload_bytes = 0
+        self.changed = asyncio.Condition()
+
+    async def add_update(self, update):
+        async with self.changed:
+            update['update_id'] = self.next_update_id
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.changed.notify_all()
+
+    async def record(self, chat_id, method, params, message_id=None):
+        async with self.changed:
+            self.seq += 1
+            self.events[chat_id].append({'seq': self.seq, 't': time.time(), 'method': method,
+                                         'message_id': message_id, 'text': params.get('text', ''),
+                                         'reply_markup': params.get('reply_markup')})
+            self.changed.notify_all()
+
+def make_message(chat_id, message_id, text=None, **extra):
+    message = {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+               'chat': {'id': chat_id, 'type': 'private'}}
+    if text is not None:
+        message['text'] = text
+    message.update(extra)
+    return message
+
+def create_stub_app(state):
+
+    def ok(result):
+        return web.json_response({'ok': True, 'result': result})
+
+    async def read_params(request):
+        if request.content_type == 'multipart/form-data':
+            params = {}
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    size = 0
+                    while chunk := await part.read_chunk():
+                        size += len(chunk)
+                    state.upload_bytes += size
+                    params[part.name] = {'file_name': part.filename, 'size': size}
+                else:
+                    params[part.name] = await part.text()
+            return params
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    async def send_document(chat_id, method, file_name):
+        state.message_ids[chat_id] += 1
+        message_id = state.message_ids[chat_id]
+        await state.record(chat_id, method, {'text': file_name}, message_id)
+        return make_message(chat_id, message_id, document={
+            'file_id': f"file-{chat_id}-{message_id}", 'file_unique_id': f"u{chat_id}{message_id}",
+            'file_name': file_name})
+
+    async def get_updates(params):
+        offset = int(params.get('offset') or 0)
+        timeout = min(float(params.get('timeout') or 0), 10)
+        deadline = time.monotonic() + timeout
+        async with state.changed:
+            state.updates = [u for u in state.updates if u['update_id'] >= offset]
+            while not state.updates and time.monotonic() < deadline:
+                try:
+                    await asyncio.wait_for(state.changed.wait(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    break
+            return list(state.updates)
+
+    async def handle_method(request):
+        method = request.match_info['method']
+        state.calls[method] += 1
+        params = await read_params(request)
+        chat_id = params.get('chat_id')
+        if chat_id is not None and str(chat_id).lstrip('-').isdigit():
+            chat_id = int(chat_id)
+
+        if method == 'getMe':
+            return ok(BOT_USER)
+        if method == 'getUpdates':
+            return ok(await get_updates(params))
+        if method == 'getChatMember':
+            return ok({'status': 'member', 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'user'}})
+        if method == 'sendMessage':
+            state.message_ids[chat_id] += 1
+            message_id = state.message_ids[chat_id]
+            await state.record(chat_id, method, params, message_id)
+            return ok(make_message(chat_id, message_id, params.get('text')))
+        if method == 'editMessageText':
+            message_id = int(params['message_id'])
+            await state.record(chat_id, method, params, message_id)
+            return ok(make_message(chat_id, message_id, params.get('text')))
+        if method == 'sendDocument':
+            document = params.get('document')
+            file_name = document['file_name'] if isinstance(document, dict) else 'cached'
+            return ok(await send_document(chat_id, method, file_name))
+        if method == 'sendMediaGroup':
+            media = params['media'] if isinstance(params['media'], list) else json.loads(params['media'])
+            messages = []
+            for entry in media:
+                source = entry['media']
+                file_name = params[source[len('attach://'):]]['file_name'] if source.startswith('attach://') else 'cached'
+                messages.append(await send_document(chat_id, method, file_name))
+            return ok(messages)
+        if method == 'deleteMessage' and chat_id is not None:
+            await state.record(chat_id, method, params, int(params['message_id']))
+        return ok(True)
+
+    async def control_update(request):
+        await state.add_update(await request.json())
+        return web.json_response({'ok': True})
+
+    async def control_events(request):
+        chat_id = int(request.query['chat_id'])
+        after = int(request.query.get('after', 0))
+        deadline = time.monotonic() + float(request.query.get('timeout', 30))
+        async with state.changed:
+            while True:
+                events = [e for e in state.events[chat_id] if e['seq'] > after]
+                if events or time.monotonic() >= deadline:
+                    return web.json_response(events)
+                try:
+                    await asyncio.wait_for(state.changed.wait(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    pass
+
+    async def control_stats(request):
+        return web.json_response({'calls': dict(state.calls), 'upload_bytes': state.upload_bytes})
+
+    stub = web.Application(client_max_size=1024 ** 3)
+    stub.router.add_post('/_control/updates', control_update)
+    stub.router.add_get('/_control/events', control_events)
+    stub.router.add_get('/_control/stats', control_stats)
+    stub.router.add_route('*', '/bot{token}/{method}', handle_method)
+    return stub
+
+def parse_keyboard(reply_markup):
+    """callback_data values of an inline keyboard, as sent by the bot"""
+    if not reply_markup:
+        return []
+    markup = json.loads(reply_markup) if isinstance(reply_markup, str) else reply_markup
+    return [button['callback_data'] for row in markup.get('inline_keyboard', []) for button in row
+            if 'callback_data' in button]
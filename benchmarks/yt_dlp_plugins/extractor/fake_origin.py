@@ -0,0 +1,17 @@
+from yt_dlp.extractor.common import InfoExtractor
+
+class FakeOriginIE(InfoExtractor):
+    """Extractor for the load-test origin in benchmarks/fake_origin.py"""
+
+    IE_NAME = 'fakeorigin'
+    _VALID_URL = r'https?://(?P<host>127\.0\.0\.1:\d+)/watch\?v=(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        host, video_id = self._match_valid_url(url).group('host', 'id')
+        data = self._download_json(f'http://{host}/api/video/{video_id}', video_id)
+        return {
+            'id': video_id,
+            'title': data['title'],
+            'duration': data['duration'],
+            'formats': data['formats'],
+        }
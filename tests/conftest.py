@@ -0,0 +1,7 @@
+import os
+import sys
+
+# app reads its settings at import time; keep the tests away from the on-disk caches
+os.environ.setdefault("RESULT_CACHE_DB", "memory")
+os.environ.pop("METADATA_CACHE_DB", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,20 @@
+"""Links recognised in a user's message."""
+import pytest
+
+import app
+
+@pytest.mark.parametrize("text, expected", [
+    ("https://www.youtube.com/watch?v=abc", ["https://www.youtube.com/watch?v=abc"]),
+    # Pasted without a scheme, as the baseline accepted through yt-dlp's generic extractor
+    ("youtube.com/watch?v=abc", ["https://youtube.com/watch?v=abc"]),
+    ("see www.youtube.com/watch?v=abc, and youtu.be/xyz.",
+     ["https://www.youtube.com/watch?v=abc", "https://youtu.be/xyz"]),
+    ("(vimeo.com/123)", ["https://vimeo.com/123"]),
+    ("https://youtu.be/a youtu.be/a", ["https://youtu.be/a"]),
+    # Not links: words with dots, e-mail-like tokens, bare host names
+    ("e.g. notes.txt", []),
+    ("write to me@example.com/x", []),
+    ("youtube.com", []),
+])
+def test_extract_urls(text, expected):
+    assert app.extract_urls(text) == expected
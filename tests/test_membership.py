@@ -0,0 +1,52 @@
+"""MembershipService only caches real getChatMember answers."""
+import asyncio
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut
+
+import app
+
+class FakeBot:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    async def get_chat_member(self, chat, user_id):
+        self.calls += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return type("Member", (), {"status": result})()
+
+def check(bot):
+    service = app.MembershipService("@group", 3600, 60, 100)
+    return service, asyncio.run(service.is_member(bot, 1))
+
+def test_status_results_are_cached():
+    service, result = check(FakeBot("left"))
+    assert result is False and service.cached(1) is False
+    service, result = check(FakeBot("member"))
+    assert result is True and service.cached(1) is True
+
+def test_transient_errors_retry_then_let_through_uncached():
+    service, result = check(FakeBot(TimedOut(), "left"))
+    assert result is False and service.cached(1) is False
+    bot = FakeBot(TimedOut(), TimedOut())
+    service, result = check(bot)
+    assert result is True and bot.calls == 2 and service.cached(1) is None
+
+def test_short_flood_wait_is_honoured():
+    bot = FakeBot(RetryAfter(0), "member")
+    service, result = check(bot)
+    assert result is True and bot.calls == 2
+    bot = FakeBot(RetryAfter(600))
+    service, result = check(bot)
+    assert result is True and bot.calls == 1 and service.cached(1) is None
+
+def test_configuration_errors_are_not_cached():
+    for error in (BadRequest("Chat not found"), Forbidden("bot is not a member of the channel chat")):
+        service, result = check(FakeBot(error))
+        assert result is True and service.cached(1) is None
+
+def test_unknown_user_is_refused_without_caching():
+    service, result = check(FakeBot(BadRequest("User not found")))
+    assert result is False and service.cached(1) is None
@@ -0,0 +1,78 @@
+"""The bandwidth budget against a real yt-dlp fragmented download.
+
+RateShare relies on yt-dlp internals (FileDownloader.slow_down and the params copy FragmentFD
+hands its fragment downloaders); yt-dlp is pinned, and this catches an upgrade that breaks it."""
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import yt_dlp
+
+import app
+
+SEGMENTS = 24
+SEGMENT_SIZE = 128 * 1024
+BUDGET = 1024 * 1024
+
+class StreamHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/stream.m3u8':
+            lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:0']
+            for i in range(SEGMENTS):
+                lines += ['#EXTINF:2.0,', f'seg{i}.ts']
+            lines.append('#EXT-X-ENDLIST')
+            body, content_type = '\n'.join(lines).encode(), 'application/vnd.apple.mpegurl'
+        else:
+            body, content_type = os.urandom(SEGMENT_SIZE), 'video/mp2t'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def stream_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StreamHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/stream.m3u8"
+    server.shutdown()
+
+def download(url, tmp_path, tuner, name):
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'fixup': 'never',
+        'outtmpl': str(tmp_path / f"{name}.%(ext)s"),
+        'concurrent_fragment_downloads': tuner.concurrency,
+    }
+    started = time.monotonic()
+    with yt_dlp.YoutubeDL(opts) as ydl, tuner.limit(ydl.params):
+        ydl.download([url])
+    return time.monotonic() - started
+
+def test_fragmented_download_stays_under_budget(stream_url, tmp_path):
+    tuner = app.DownloadTuner(4, app.HTTP_CHUNK_SIZE, BUDGET)
+    elapsed = download(stream_url, tmp_path, tuner, "one")
+    expected = SEGMENTS * SEGMENT_SIZE / BUDGET
+    # Not over budget (with some slack for the first block of each connection), and not split too finely
+    assert expected * 0.8 <= elapsed <= expected * 2
+
+def test_budget_is_shared_by_running_downloads(stream_url, tmp_path):
+    tuner = app.DownloadTuner(4, app.HTTP_CHUNK_SIZE, BUDGET)
+    results = {}
+    threads = [threading.Thread(target=lambda name=name: results.update({name: download(stream_url, tmp_path, tuner, name)}))
+               for name in ("a", "b")]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    expected = 2 * SEGMENTS * SEGMENT_SIZE / BUDGET
+    assert len(results) == 2 and not tuner.active
+    assert expected * 0.8 <= elapsed <= expected * 2
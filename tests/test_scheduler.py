@@ -0,0 +1,81 @@
+"""DownloadScheduler slot accounting when jobs are cancelled, as run_batch and shutdown do."""
+import asyncio
+import threading
+
+import app
+
+def make_scheduler(max_active=1, per_user=1):
+    return app.DownloadScheduler(max_active, per_user, 5, 50, app.MemoryBackend())
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0.01)
+
+def test_cancel_running_and_queued_together():
+    async def scenario():
+        scheduler = make_scheduler()
+        started, finish = threading.Event(), threading.Event()
+
+        def job():
+            started.set()
+            finish.wait(5)
+            return "done"
+
+        running = asyncio.create_task(scheduler.run("U", job))
+        queued = asyncio.create_task(scheduler.run("U", job))
+        await settle()
+        assert started.is_set() and scheduler.queue_length() == 1
+
+        running.cancel()
+        queued.cancel()
+        await asyncio.gather(running, queued, return_exceptions=True)
+        # The worker thread is still downloading, so its slot stays taken
+        assert scheduler.active == {"U": 1}
+
+        finish.set()
+        await settle()
+        assert scheduler.active_total == 0 and scheduler.active == {}
+        assert scheduler.queue_length() == 0
+
+        result = await asyncio.wait_for(scheduler.run("U", lambda: "again"), 2)
+        assert result == "again"
+        scheduler.executor.shutdown()
+
+    asyncio.run(scenario())
+
+def test_cancelled_tickets_are_skipped():
+    async def scenario():
+        scheduler = make_scheduler(max_active=1, per_user=2)
+        finish = threading.Event()
+        blocker = asyncio.create_task(scheduler.run("A", finish.wait, 5))
+        waiting = [asyncio.create_task(scheduler.run(user, lambda: user)) for user in ("A", "B", "B")]
+        await settle()
+        assert scheduler.queue_length() == 3
+
+        for task in waiting[:2]:
+            task.cancel()
+        await asyncio.gather(*waiting[:2], return_exceptions=True)
+        finish.set()
+
+        assert await asyncio.wait_for(waiting[2], 2) == "B"
+        await blocker
+        await settle()
+        assert scheduler.active_total == 0 and scheduler.stats['started'] == 2
+        scheduler.executor.shutdown()
+
+    asyncio.run(scenario())
+
+def test_batch_allowance_overrides_per_user_cap():
+    async def scenario():
+        scheduler = make_scheduler(max_active=4, per_user=1)
+        finish = threading.Event()
+        jobs = [asyncio.create_task(scheduler.run("U", finish.wait, 5, max_active=3)) for _ in range(4)]
+        await settle()
+        assert scheduler.active == {"U": 3} and scheduler.queue_length() == 1
+        finish.set()
+        await asyncio.gather(*jobs)
+        await settle()
+        assert scheduler.active_total == 0
+        scheduler.executor.shutdown()
+
+    asyncio.run(scenario())
@@ -0,0 +1,69 @@
+"""select_format against format lists shaped like yt-dlp -J output, trimmed to the
+fields the selector reads. YouTube lists are the web client's (HLS skipped, as in the
+standard download profile); the lecture is a 21-minute low-bitrate upload."""
+import json
+import os
+
+import pytest
+
+import app
+
+FORMATS_DIR = os.path.join(os.path.dirname(__file__), "formats")
+UPLOAD_LIMIT = 50 * 1024 * 1024
+
+def load(name):
+    with open(os.path.join(FORMATS_DIR, f"{name}.json")) as f:
+        recorded = json.load(f)
+    return (*app.split_formats(recorded["formats"]), recorded["duration"])
+
+def choose(name, format_type, quality):
+    video_formats, audio_formats, duration = load(name)
+    spec = app.select_format(format_type, quality, video_formats, audio_formats, duration, UPLOAD_LIMIT)
+    return spec.split("/")[0]
+
+@pytest.mark.parametrize("name, quality, expected", [
+    # The muxed 360p file needs no merge
+    ("youtube_music_video", "360", "18"),
+    # H.264 at the exact height, merged with the AAC track
+    ("youtube_music_video", "720", "136+140"),
+    # 1080p H.264 (137) is over budget; AV1 in MP4 fits and merges without remuxing
+    ("youtube_music_video", "best", "399+140"),
+    ("youtube_lecture", "360", "18"),
+    # Nothing above 360p fits in 50MB once the audio is added
+    ("youtube_lecture", "720", "18"),
+    ("youtube_lecture", "best", "18"),
+    ("vimeo", "360", "http-360p"),
+    # 720p is over budget both progressive and as HLS video + audio
+    ("vimeo", "720", "http-540p"),
+    ("vimeo", "best", "http-540p"),
+])
+def test_video_choice(name, quality, expected):
+    assert choose(name, "mp4", quality) == expected
+
+@pytest.mark.parametrize("name, format_type, expected", [
+    ("youtube_music_video", "m4a", "140"),
+    # No MP3 source on YouTube: AAC beats Opus for the transcode too
+    ("youtube_music_video", "mp3", "140"),
+    # Sources the target can remux without re-encoding win, progressive over HLS
+    ("soundcloud", "mp3", "http_mp3_128"),
+    ("soundcloud", "m4a", "hls_aac_160"),
+])
+def test_audio_choice(name, format_type, expected):
+    assert choose(name, format_type, "best") == expected
+
+def test_audio_only_source_falls_back_for_video():
+    video_formats, audio_formats, duration = load("soundcloud")
+    assert app.select_format("mp4", "720", video_formats, audio_formats, duration, UPLOAD_LIMIT) == "best/worst"
+
+def test_missing_acodec_counts_as_muxed():
+    # Generic pages often report no codecs; like split_formats, that means audio is present,
+    # so the 40MB file fits on its own instead of being charged for a merge it won't get
+    video_formats = [
+        {"format_id": "direct", "height": 720, "ext": "mp4", "filesize": 40 * 1024 * 1024},
+        {"format_id": "dash-720", "height": 720, "ext": "mp4", "vcodec": "avc1.64001F", "acodec": "none",
+         "filesize": 36 * 1024 * 1024},
+    ]
+    audio_formats = [{"format_id": "dash-audio", "ext": "m4a", "acodec": "mp4a.40.2", "vcodec": "none",
+                      "filesize": 15 * 1024 * 1024}]
+    spec = app.select_format("mp4", "720", video_formats, audio_formats, 600, UPLOAD_LIMIT)
+    assert spec.split("/")[0] == "direct"
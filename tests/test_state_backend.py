@@ -0,0 +1,102 @@
+"""StateBackend contract, run against the in-process backends (Redis needs a server)."""
+import asyncio
+import time
+
+import pytest
+
+import app
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return app.MemoryBackend()
+    return app.SQLiteBackend(str(tmp_path / "state.db"))
+
+def test_set_get_delete(backend):
+    expires = time.time() + 60
+    backend.set("things", "a", {"n": 1}, expires)
+    assert backend.get("things", "a") == ({"n": 1}, expires)
+    backend.delete("things", "a")
+    assert backend.get("things", "a") is None
+
+def test_expired_entries_are_missing(backend):
+    backend.set("things", "old", 1, time.time() - 1)
+    assert backend.get("things", "old") is None
+
+def test_least_recently_used_is_evicted(backend):
+    expires = time.time() + 60
+    for key in ("a", "b", "c"):
+        backend.set("things", key, key, expires, max_entries=3)
+        time.sleep(0.01)
+    assert backend.get("things", "a")  # "b" is now the oldest
+    backend.set("things", "d", "d", expires, max_entries=3)
+    assert backend.get("things", "b") is None
+    assert all(backend.get("things", key) for key in ("a", "c", "d"))
+
+def test_incr_restarts_after_expiry(backend):
+    assert backend.incr("counters", "u", 1, time.time() + 60) == 1
+    assert backend.incr("counters", "u", 2, time.time() + 60) == 3
+    assert backend.incr("counters", "u", -1, time.time() - 1) == 2
+    assert backend.incr("counters", "u", 1, time.time() + 60) == 1
+
+def test_async_variants(backend):
+    async def scenario():
+        expires = time.time() + 60
+        await backend.aset("things", "a", [1, 2], expires)
+        assert (await backend.aget("things", "a"))[0] == [1, 2]
+        assert await backend.aincr("counters", "u", 5, expires) == 5
+        await backend.adelete("things", "a")
+        assert await backend.aget("things", "a") is None
+
+    asyncio.run(scenario())
+
+def test_sqlite_reads_do_not_write(tmp_path):
+    backend = app.SQLiteBackend(str(tmp_path / "state.db"))
+    backend.set("things", "a", 1, time.time() + 60)
+    backend.set("things", "old", 1, time.time() - 1)
+    changes = backend.conn.total_changes
+    assert backend.get("things", "a")
+    assert backend.get("things", "old") is None
+    assert backend.conn.total_changes == changes
+
+def test_sqlite_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / "state.db")
+    first, second = app.SQLiteBackend(path), app.SQLiteBackend(path)
+    first.set("things", "a", {"x": 1}, time.time() + 60)
+    assert second.get("things", "a")[0] == {"x": 1}
+    first.incr("counters", "u", 1, time.time() + 60)
+    assert second.incr("counters", "u", 1, time.time() + 60) == 2
+
+def test_session_store_round_trip(tmp_path):
+    async def scenario():
+        store = app.SessionStore(app.SQLiteBackend(str(tmp_path / "state.db")), 60, 10)
+        session = await store.create(1, 2, "https://example.com/v", urls=["https://example.com/v"])
+        session.format_type = "video"
+        await store.save(session)
+        loaded = await store.get(session.token)
+        assert (loaded.url, loaded.format_type, loaded.urls) == (session.url, "video", session.urls)
+        await store.pop(session.token)
+        assert await store.get(session.token) is None
+
+    asyncio.run(scenario())
+
+def test_per_user_cap_spans_workers(tmp_path):
+    """Two schedulers on one SQLite file act like two worker processes"""
+    async def scenario():
+        path = str(tmp_path / "state.db")
+        workers = [app.DownloadScheduler(2, 1, 5, 50, app.SQLiteBackend(path)) for _ in range(2)]
+        await workers[0].acquire("U")
+        await asyncio.sleep(0.1)  # let the counter write land
+        waiting = asyncio.create_task(workers[1].acquire("U"))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+
+        workers[0].release("U")
+        await asyncio.wait_for(waiting, 3)
+        assert workers[1].active == {"U": 1}
+        workers[1].release("U")
+        await asyncio.sleep(0.1)
+        for worker in workers:
+            worker.executor.shutdown()
+
+    asyncio.run(scenario())